@@ -10,7 +10,9 @@ from trytond.pool import Pool
 
 from project import WebSite, ProjectUsers, ProjectInvitation, \
     ProjectWorkInvitation, Project, Tag, TaskTags, \
-    ProjectHistory, ProjectWorkCommit
+    ProjectHistory, ProjectHistoryArchive, ProjectWorkCommit, ProjectMember, \
+    ProjectParticipantRemoval, Attachment, ProjectUpload, \
+    AttachmentBlob, AttachmentThumbnail, MailOutbox, ProjectNotification
 from company import Company, CompanyProjectAdmins, NereidUser
 
 
@@ -25,8 +27,17 @@ def register():
         Project,
         Tag,
         TaskTags,
+        ProjectHistoryArchive,
         ProjectHistory,
         ProjectWorkCommit,
+        ProjectMember,
+        ProjectParticipantRemoval,
+        AttachmentBlob,
+        Attachment,
+        AttachmentThumbnail,
+        ProjectUpload,
+        MailOutbox,
+        ProjectNotification,
         Company,
         CompanyProjectAdmins,
         NereidUser,
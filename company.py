@@ -9,9 +9,11 @@
 """
 from datetime import datetime
 
-from nereid import request
+from nereid import request, login_required, jsonify, redirect, flash, abort
 from trytond.pool import Pool, PoolMeta
 from trytond.model import ModelSQL, fields
+from trytond.cache import Cache
+from trytond.pyson import Eval
 
 __all__ = ['Company', 'CompanyProjectAdmins', 'NereidUser']
 __metaclass__ = PoolMeta
@@ -29,6 +31,30 @@ class Company:
         'Project Administrators'
     )
 
+    #: Ids of project admins by company. The cache is shared by all the
+    #: requests and cleared when the admin relation changes
+    _project_admins_cache = Cache(
+        'company_company.get_project_admin_ids', context=False
+    )
+
+    def get_project_admin_ids(self):
+        """
+        Returns the ids of the project admins of the company as a frozenset.
+        This is cheaper than loading the project_admins Many2Many when all
+        that is needed is a membership test.
+        """
+        CompanyProjectAdmins = Pool().get('company.company-nereid.user')
+
+        admin_ids = self._project_admins_cache.get(self.id)
+        if admin_ids is None:
+            admin_ids = frozenset([
+                relation.user.id for relation in CompanyProjectAdmins.search([
+                    ('company', '=', self.id),
+                ])
+            ])
+            self._project_admins_cache.set(self.id, admin_ids)
+        return admin_ids
+
 
 class CompanyProjectAdmins(ModelSQL):
     "Company Admins"
@@ -43,6 +69,30 @@ class CompanyProjectAdmins(ModelSQL):
         'nereid.user', 'User', select=1, required=True
     )
 
+    @classmethod
+    def clear_admin_cache(cls):
+        """
+        Clear the cached admin ids of all companies
+        """
+        Company = Pool().get('company.company')
+
+        Company._project_admins_cache.clear()
+
+    @classmethod
+    def create(cls, values):
+        cls.clear_admin_cache()
+        return super(CompanyProjectAdmins, cls).create(values)
+
+    @classmethod
+    def write(cls, relations, values):
+        cls.clear_admin_cache()
+        return super(CompanyProjectAdmins, cls).write(relations, values)
+
+    @classmethod
+    def delete(cls, relations):
+        cls.clear_admin_cache()
+        return super(CompanyProjectAdmins, cls).delete(relations)
+
 
 class NereidUser:
     """
@@ -56,15 +106,35 @@ class NereidUser:
         select=True,
     )
 
+    #: Users in digest mode get the updates of their tasks merged in one
+    #: mail every digest_interval minutes instead of one mail per update
+    notification_mode = fields.Selection([
+        ('immediate', 'Immediately'),
+        ('digest', 'Digest'),
+    ], 'Notifications', required=True)
+    digest_interval = fields.Integer('Digest Interval (minutes)',
+        states={
+            'invisible': Eval('notification_mode') != 'digest',
+        }, depends=['notification_mode']
+    )
+    last_digest = fields.DateTime('Last Digest', readonly=True)
+
+    @staticmethod
+    def default_notification_mode():
+        return 'immediate'
+
+    @staticmethod
+    def default_digest_interval():
+        return 60
+
     def is_project_admin(self):
         """
         Returns True if the user is in the website admins list
 
         :return: True or False
         """
-        if self in request.nereid_website.company.project_admins:
-            return True
-        return False
+        company = request.nereid_website.company
+        return self.id in company.get_project_admin_ids()
 
     def hours_reported_today(self):
         """
@@ -84,3 +154,37 @@ class NereidUser:
         ])
 
         return sum(map(lambda line: line.hours, lines))
+
+    @classmethod
+    @login_required
+    def notification_preferences(cls):
+        """
+        Returns (GET) or changes (POST) how the current user is notified of
+        the updates of tasks: immediately or in a digest every
+        digest_interval minutes.
+        """
+        user = request.nereid_user
+
+        if request.method == 'POST':
+            mode = request.form.get(
+                'notification_mode', user.notification_mode
+            )
+            interval = request.form.get(
+                'digest_interval', user.digest_interval, type=int
+            )
+            if mode not in ('immediate', 'digest') or \
+                    not interval or interval < 1:
+                abort(400)
+            cls.write([user], {
+                'notification_mode': mode,
+                'digest_interval': interval,
+            })
+            if not request.is_xhr:
+                flash("Your notification preferences have been updated")
+                return redirect(request.referrer)
+            user = cls(user.id)
+
+        return jsonify({
+            'notification_mode': user.notification_mode,
+            'digest_interval': user.digest_interval,
+        })
@@ -7,9 +7,12 @@
     :copyright: (c) 2012-2013 by Openlabs Technologies & Consulting (P) Limited
     :license: GPLv3, see LICENSE for more details.
 """
+import os
+import sys
 import uuid
 import re
 import tempfile
+import filecmp
 import random
 import string
 import json
@@ -17,18 +20,29 @@ import warnings
 import time
 import dateutil
 import calendar
+import logging
+import base64
+import smtplib
+import hashlib
 from collections import defaultdict
 from datetime import datetime, date
 from dateutil.relativedelta import relativedelta
 from itertools import chain, cycle
 from mimetypes import guess_type
 from email.utils import parseaddr
+from email.header import Header, decode_header, make_header
+from cgi import escape
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from cStringIO import StringIO
 
 from babel.dates import parse_date
 from nereid import (request, abort, render_template, login_required, url_for,
     redirect, flash, jsonify, render_email, permissions_required)
-from flask import send_file
+from flask import Response, make_response, session, _request_ctx_stack
 from nereid.ctx import has_request_context
+from nereid.globals import cache
+from nereid.helpers import key_from_list
 from nereid.signals import registration
 from nereid.contrib.pagination import Pagination
 from trytond.model import ModelView, ModelSQL, fields
@@ -39,9 +53,19 @@ from trytond.config import CONFIG
 from trytond.tools import get_smtp_server, datetime_strftime
 from trytond.backend import TableHandler
 
-__all__ = ['WebSite', 'ProjectUsers', 'ProjectInvitation', \
-    'ProjectWorkInvitation', 'Project', 'Tag', \
-    'TaskTags', 'ProjectHistory', 'ProjectWorkCommit']
+try:
+    from PIL import Image
+except ImportError:
+    # Thumbnails are not generated without PIL
+    Image = None
+
+__all__ = ['WebSite', 'ProjectUsers', 'ProjectMember', \
+    'ProjectInvitation', 'ProjectWorkInvitation', 'Project', 'Tag', \
+    'TaskTags', 'ProjectHistory', 'ProjectHistoryArchive',
+    'ProjectWorkCommit',
+    'ProjectParticipantRemoval', 'Attachment', 'ProjectUpload',
+    'AttachmentBlob', 'AttachmentThumbnail', 'MailOutbox',
+    'ProjectNotification']
 __metaclass__ = PoolMeta
 
 
@@ -53,6 +77,159 @@ PROGRESS_STATES = [
     ('Review', 'Review/QA'),
 ]
 
+#: Tasks are processed in batches of this size when a participant is removed
+#: from a project. Projects with more tasks are handled by a background job.
+PARTICIPANT_REMOVAL_BATCH = 500
+
+#: Text search configuration of the full text index on tasks
+FTS_CONFIG = 'english'
+FTS_VECTOR = "to_tsvector('%s', COALESCE(\"search_text\", ''))" % FTS_CONFIG
+
+#: Maximum number of tasks returned by the typeahead and how long (in
+#: seconds) the typeahead results for a prefix are cached
+TYPEAHEAD_LIMIT = 10
+TYPEAHEAD_CACHE_TIMEOUT = 60
+
+#: Tasks per page of the task list and the maximum a client can ask for
+TASKS_PER_PAGE = 10
+MAX_TASKS_PER_PAGE = 100
+
+#: Fields returned by the serialization of projects and tasks. Clients can
+#: ask for a subset with the fields argument of the XHR requests.
+SERIALIZE_FIELDS = (
+    'id', 'name', 'type', 'parent', 'tags', 'assigned_to', 'attachments',
+    'state', 'progress_state', 'comment', 'effort', 'total_effort',
+    'constraint_finish_time',
+)
+
+#: Fields of project.work whose changes are recorded in the history
+HISTORIZED_FIELDS = (
+    'assigned_to', 'state', 'progress_state', 'constraint_start_time',
+    'constraint_finish_time',
+)
+
+#: Bounding boxes of the images generated for image attachments, the number
+#: of attachments processed by the cron before each commit and how long
+#: browsers may keep the images
+THUMBNAIL_SIZES = {
+    'thumbnail': (160, 160),
+    'preview': (1024, 1024),
+}
+THUMBNAIL_BATCH = 20
+THUMBNAIL_MAX_AGE = 24 * 60 * 60
+
+#: Mails sent by the outbox worker over one connection before each commit,
+#: the number of attempts before a mail is given up and the delay before
+#: the first retry, doubled at every attempt
+MAIL_BATCH = 50
+MAIL_MAX_ATTEMPTS = 6
+MAIL_RETRY_DELAY = relativedelta(minutes=5)
+
+#: History lines of tasks done are moved to the archive table when both the
+#: line and the last change of the task are older than this. The cron moves
+#: this many lines before each commit.
+HISTORY_ARCHIVE_AGE = relativedelta(days=180)
+HISTORY_ARCHIVE_BATCH = 200
+
+#: Entries of the timeline of a task shown at once, older entries are
+#: loaded on demand
+TIMELINE_LIMIT = 50
+
+#: Number of earlier updates of the task quoted in update mails
+MAIL_HISTORY_LIMIT = 10
+
+#: Number of renderings and total seconds spent by each mail template in
+#: this process, see MailOutbox.render
+RENDER_TIMINGS = defaultdict(lambda: [0, 0.0])
+
+#: Files per page of the project files and their possible orders, as SQL.
+#: Links have no size and are sorted as empty files, after the others.
+FILES_PER_PAGE = 20
+FILES_ORDER = {
+    'date': '"create_date" DESC, "id" DESC',
+    'size': 'COALESCE("file_size", 0) DESC, "id" DESC',
+    'name': '"name" ASC, "id" ASC',
+}
+
+#: Number of records read and serialized at a time by streamed responses
+STREAM_BATCH_SIZE = 200
+
+#: Size in bytes of the chunks in which attachment files are read and written
+FILE_CHUNK_SIZE = 64 * 1024
+
+#: Default maximum size in bytes of an uploaded file and of all the files of
+#: a project. Overridden by the project_max_file_size and
+#: project_max_storage options of the trytond configuration, 0 is no limit.
+MAX_FILE_SIZE = 100 * 1024 * 1024
+MAX_PROJECT_STORAGE = 0
+
+#: Time during which a file no longer attached anywhere is kept in the
+#: store before it is removed
+BLOB_GRACE_PERIOD = relativedelta(hours=1)
+
+#: Size in bytes of the chunks clients are asked to send in resumable
+#: uploads and the time after which unfinished uploads are removed
+RESUMABLE_CHUNK_SIZE = 4 * 1024 * 1024
+RESUMABLE_UPLOAD_EXPIRY = relativedelta(days=1)
+
+logger = logging.getLogger('nereid_project')
+
+
+class RankedPagination(Pagination):
+    """
+    Pagination of the works matching a full text query, best match first.
+    The matches of a page are selected by the database and the number of
+    matches is given, as it is known from the facet counts.
+    """
+
+    def __init__(self, obj, query, domain, page, per_page, count):
+        self.query = query
+        self._count = count
+        super(RankedPagination, self).__init__(obj, domain, page, per_page)
+
+    @property
+    def count(self):
+        return self._count
+
+    def all_items(self):
+        return self.obj.browse(self.obj.search_fulltext(
+            self.query, self.domain
+        ))
+
+    def items(self):
+        return self.obj.browse(self.obj.search_fulltext(
+            self.query, self.domain,
+            offset=(self.page - 1) * self.per_page, limit=self.per_page
+        ))
+
+
+class FilesPagination(Pagination):
+    """
+    Pagination of the files of a project and its tasks. The files of a page
+    are selected by the database in the given order (see FILES_ORDER).
+    """
+
+    def __init__(self, obj, project, file_type, order, page, per_page):
+        self.project = project
+        self.file_type = file_type
+        self.file_order = order
+        super(FilesPagination, self).__init__(obj, [], page, per_page)
+
+    @property
+    def count(self):
+        return self.obj.count_project_files(self.project, self.file_type)
+
+    def all_items(self):
+        return self.obj.browse(self.obj.search_project_files(
+            self.project, self.file_type, self.file_order
+        ))
+
+    def items(self):
+        return self.obj.browse(self.obj.search_project_files(
+            self.project, self.file_type, self.file_order,
+            offset=(self.page - 1) * self.per_page, limit=self.per_page
+        ))
+
 
 class WebSite:
     """
@@ -97,6 +274,180 @@ class ProjectUsers(ModelSQL):
                 'project_work-nereid_user'
             )
 
+    @classmethod
+    def create(cls, values):
+        ProjectMember = Pool().get('project.work.member')
+
+        relation = super(ProjectUsers, cls).create(values)
+        ProjectMember.update_members([relation.project])
+        return relation
+
+    @classmethod
+    def write(cls, relations, values):
+        ProjectMember = Pool().get('project.work.member')
+
+        projects = [r.project for r in relations]
+        rv = super(ProjectUsers, cls).write(relations, values)
+        projects.extend([
+            r.project for r in cls.browse(map(int, relations))
+        ])
+        ProjectMember.update_members(projects)
+        return rv
+
+    @classmethod
+    def delete(cls, relations):
+        ProjectMember = Pool().get('project.work.member')
+
+        projects = [r.project for r in relations]
+        rv = super(ProjectUsers, cls).delete(relations)
+        ProjectMember.update_members(projects)
+        return rv
+
+
+class ProjectMember(ModelSQL):
+    '''
+    Effective members of a project work.
+
+    The effective members of a work are its own participants and the
+    participants of all its ancestors. They are stored denormalized so
+    that membership tests and participant dropdowns are a single indexed
+    lookup instead of a recursive walk up the parents. Project admins are
+    not stored here, they come from the cached admin ids of the company.
+    '''
+    __name__ = 'project.work.member'
+
+    work = fields.Many2One(
+        'project.work', 'Work', ondelete='CASCADE', select=True,
+        required=True
+    )
+    user = fields.Many2One(
+        'nereid.user', 'User', ondelete='CASCADE', select=True,
+        required=True
+    )
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().cursor
+        created = not TableHandler.table_exist(cursor, cls._table)
+
+        super(ProjectMember, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['work', 'user'], 'add')
+        table.index_action(['user', 'work'], 'add')
+
+        if created:
+            # Fill the table from the existing participants
+            Work = Pool().get('project.work')
+            with Transaction().set_context(active_test=False):
+                cls.update_members(Work.search([('parent', '=', False)]))
+
+    @classmethod
+    def get_user_ids(cls, works):
+        """
+        Returns a dictionary of work id to the set of ids of its effective
+        members (admins excluded) in a single query.
+
+        :param works: list of active records of project.work
+        """
+        cursor = Transaction().cursor
+
+        work_ids = list(set(map(int, works)))
+        res = dict((work_id, set()) for work_id in work_ids)
+        for i in range(0, len(work_ids), cursor.IN_MAX):
+            sub_ids = work_ids[i:i + cursor.IN_MAX]
+            cursor.execute(
+                'SELECT "work", "user" FROM "' + cls._table + '" '
+                'WHERE "work" IN (' + ','.join(('%s',) * len(sub_ids)) + ')',
+                sub_ids
+            )
+            for work_id, user_id in cursor.fetchall():
+                res[work_id].add(user_id)
+        return res
+
+    @classmethod
+    def update_members(cls, works):
+        """
+        Recompute the effective members of the given works and all their
+        descendants, inserting and deleting only the members which changed.
+
+        :param works: list of active records of project.work
+        """
+        Work = Pool().get('project.work')
+        ProjectUsers = Pool().get('project.work-nereid.user')
+        cursor = Transaction().cursor
+
+        work_ids = set(map(int, works))
+        if not work_ids:
+            return
+
+        with Transaction().set_context(active_test=False):
+            # Collect the descendants level by level, the trees are shallow
+            new_ids = work_ids
+            while new_ids:
+                new_ids = set(map(int, Work.search([
+                    ('parent', 'in', list(new_ids)),
+                ]))) - work_ids
+                work_ids |= new_ids
+            works = Work.browse(list(work_ids))
+
+        parent_ids = dict(
+            (w.id, w.parent and w.parent.id or None) for w in works
+        )
+        own_members = defaultdict(set)
+        for relation in ProjectUsers.search([
+                ('project', 'in', list(work_ids))]):
+            own_members[relation.project.id].add(relation.user.id)
+
+        # Parents outside the recomputed set are already up to date
+        members = cls.get_user_ids([
+            p for p in parent_ids.values() if p and p not in work_ids
+        ])
+
+        def get_members(work_id):
+            if work_id not in members:
+                parent_id = parent_ids[work_id]
+                members[work_id] = own_members[work_id] | (
+                    parent_id and get_members(parent_id) or set()
+                )
+            return members[work_id]
+
+        # Only the rows which changed are written
+        now = datetime.utcnow()
+        user = Transaction().user
+        stored = cls.get_user_ids(list(work_ids))
+        rows = []
+        removed = defaultdict(list)
+        for work_id in work_ids:
+            rows.extend([
+                (work_id, user_id, user, now)
+                for user_id in get_members(work_id) - stored[work_id]
+            ])
+            for user_id in stored[work_id] - get_members(work_id):
+                removed[user_id].append(work_id)
+
+        # The statements stay below the number of parameters of the
+        # database, the user takes one of them and each row four
+        in_max = cursor.IN_MAX - 1
+        for user_id, removed_ids in removed.iteritems():
+            for i in range(0, len(removed_ids), in_max):
+                sub_ids = removed_ids[i:i + in_max]
+                cursor.execute(
+                    'DELETE FROM "' + cls._table + '" '
+                    'WHERE "user" = %s AND "work" IN (' +
+                    ','.join(('%s',) * len(sub_ids)) + ')',
+                    [user_id] + sub_ids
+                )
+        step = cursor.IN_MAX // 4
+        for i in range(0, len(rows), step):
+            sub_rows = rows[i:i + step]
+            cursor.execute(
+                'INSERT INTO "' + cls._table + '" '
+                '("work", "user", "create_uid", "create_date") '
+                'VALUES ' + ','.join(('(%s, %s, %s, %s)',) * len(sub_rows)),
+                list(chain.from_iterable(sub_rows))
+            )
+
 
 class ProjectInvitation(ModelSQL, ModelView):
     "Project Invitation store"
@@ -166,6 +517,8 @@ class ProjectInvitation(ModelSQL, ModelView):
     def resend_invite(self):
         """Resend the invite to a participant
         """
+        Outbox = Pool().get('project.mail.outbox')
+
         # Check if user is among the project admins
         if not request.nereid_user.is_project_admin():
             flash("Sorry! You are not allowed to resend invites. \
@@ -181,10 +534,7 @@ class ProjectInvitation(ModelSQL, ModelView):
                 from_email=CONFIG['smtp_from'], project=self.project,
                 invitation=self
             )
-            server = get_smtp_server()
-            server.sendmail(CONFIG['smtp_from'], [self.email],
-                email_message.as_string())
-            server.quit()
+            Outbox.queue([self.email], email_message)
 
             if request.is_xhr:
                 return jsonify({
@@ -224,6 +574,10 @@ class Project:
     history = fields.One2Many('project.work.history', 'project',
         'History', readonly=True
     )
+    archived_history = fields.One2Many(
+        'project.work.history.archive', 'project', 'Archived History',
+        readonly=True
+    )
     participants = fields.Many2Many(
         'project.work-nereid.user', 'project', 'user',
         'Participants'
@@ -248,11 +602,17 @@ class Project:
 
     created_by = fields.Many2One('nereid.user', 'Created by')
 
+    #: Effective members of the work: own participants and those of all
+    #: the ancestors. Maintained by project.work.member
+    members = fields.Many2Many(
+        'project.work.member', 'work', 'user', 'Members', readonly=True
+    )
+
     all_participants = fields.Function(
         fields.Many2Many(
             'project.work-nereid.user', 'project', 'user',
             'All Participants', depends=['company']
-        ), 'get_all_participants'
+        ), 'get_all_participants', searcher='search_all_participants'
     )
     assigned_to = fields.Many2One(
         'nereid.user', 'Assigned to', depends=['all_participants'],
@@ -282,6 +642,79 @@ class Project:
         'project.work.commit', 'project', 'Repo Commits'
     )
 
+    #: Name, description and comments of the work, kept up to date for the
+    #: full text search
+    search_text = fields.Text('Search Text', readonly=True)
+
+    #: Counters of the related records, maintained when history lines and
+    #: attachments are created or deleted so that task lists do not have
+    #: to load the records to count them
+    comment_count = fields.Integer('Comments', readonly=True)
+    attachment_count = fields.Integer('Attachments', readonly=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().cursor
+
+        counters_exist = TableHandler.table_exist(cursor, cls._table) and \
+            TableHandler(cursor, cls, module_name).column_exist(
+                'comment_count'
+            )
+
+        super(Project, cls).__register__(module_name)
+
+        if not counters_exist:
+            # The new columns are filled with the defaults, the counters
+            # of the existing works are computed when all the counted
+            # tables are registered (see ProjectWorkCommit.__register__)
+            cursor.execute(
+                'UPDATE "' + cls._table + '" SET "comment_count" = NULL'
+            )
+
+        if CONFIG['db_type'] == 'postgresql':
+            index_name = cls._table + '_search_text_fts_index'
+            cursor.execute(
+                'SELECT 1 FROM pg_indexes WHERE indexname = %s', (index_name,)
+            )
+            if not cursor.fetchone():
+                cursor.execute(
+                    'CREATE INDEX "' + index_name + '" ON "' + cls._table +
+                    '" USING gin (' + FTS_VECTOR + ')'
+                )
+
+            # Trigram index on the task names (which live in timesheet.work)
+            # for the typeahead. The pg_trgm extension must be installed by
+            # the database administrator.
+            TimesheetWork = Pool().get('timesheet.work')
+            index_name = TimesheetWork._table + '_name_trgm_index'
+            cursor.execute(
+                'SELECT 1 FROM pg_indexes WHERE indexname = %s', (index_name,)
+            )
+            if not cursor.fetchone():
+                cursor.execute(
+                    'SELECT 1 FROM pg_extension WHERE extname = %s',
+                    ('pg_trgm',)
+                )
+                if cursor.fetchone():
+                    cursor.execute(
+                        'CREATE INDEX "' + index_name + '" ON "' +
+                        TimesheetWork._table + '" USING gin '
+                        '("name" gin_trgm_ops)'
+                    )
+                else:
+                    logger.warning(
+                        'pg_trgm extension is not installed, the task '
+                        'typeahead will not be indexed'
+                    )
+
+    @staticmethod
+    def default_comment_count():
+        return 0
+
+    @staticmethod
+    def default_attachment_count():
+        return 0
+
     @staticmethod
     def default_progress_state():
         '''
@@ -295,53 +728,171 @@ class Project:
         """
         Put recent projects into the home
         """
-        if request.nereid_user.is_project_admin():
-            # Display all projects to project admin
-            projects = cls.search([
-                ('type', '=', 'project'),
-                ('parent', '=', False),
-            ])
-        else:
-            projects = cls.search([
-                ('participants', '=', request.nereid_user.id),
-                ('type', '=', 'project'),
-                ('parent', '=', False),
-            ])
+        # Project admins get all the projects, others only the projects
+        # they participate in
+        domain = [
+            ('type', '=', 'project'),
+            ('parent', '=', False),
+        ] + cls.get_access_domain(request.nereid_user)
+
+        etag = cls.get_etag(domain)
+        not_modified = cls.not_modified(etag)
+        if not_modified:
+            return not_modified
+
+        projects = cls.search(domain)
         if request.is_xhr:
-            return jsonify({
+            return cls.with_etag(jsonify({
                 'itemCount': len(projects),
-                'items': map(lambda project: project.serialize(), projects),
-            })
-        return render_template('project/home.jinja', projects=projects)
+                'items': cls.serialize_many(
+                    projects, cls.get_serialize_fields()
+                ),
+            }), etag)
+        return cls.with_etag(
+            render_template('project/home.jinja', projects=projects), etag
+        )
 
-    def serialize(self):
+    def serialize(self, fields_names=None):
         """
         Serialize a record, which could be a task or project
 
+        :param fields_names: The fields to serialize, all by default
         """
-        assigned_to = None
-        if self.assigned_to:
-            assigned_to = {
-                'id': self.assigned_to.id,
-                'display_name': self.assigned_to.display_name,
-            }
+        return self.serialize_many([self], fields_names)[0]
 
-        return {
-            'id': self.id,
-            'name': self.name,
-            'type': self.type,
-            'parent': self.parent and self.parent.id or None,
-            # Task specific
-            'tags': map(lambda t: t.name, self.tags),
-            'assigned_to': assigned_to,
-            'attachments': len(self.attachments),
-            'progress_state': self.progress_state,
-            'comment': self.comment,
-            'effort': self.effort,
-            'total_effort': self.total_effort,
-            'constraint_finish_time': self.constraint_finish_time and \
-                self.constraint_finish_time.isoformat() or None,
-        }
+    @classmethod
+    def serialize_many(cls, records, fields_names=None):
+        """
+        Serialize a list of records, which could be tasks or projects. The
+        tags and assignees of all the records are fetched together, so the
+        number of queries does not depend on the number of records.
+
+        :param records: List of active records of project.work
+        :param fields_names: The fields to serialize, all by default. Only
+                             these fields are computed.
+        """
+        TaskTags = Pool().get('project.work-project.work.tag')
+        Tag = Pool().get('project.work.tag')
+        NereidUser = Pool().get('nereid.user')
+
+        if fields_names is None:
+            fields_names = SERIALIZE_FIELDS
+        fields_names = set(fields_names) | set(['id'])
+
+        ids = map(int, records)
+        if not ids:
+            return []
+
+        read_fields = [
+            f for f in SERIALIZE_FIELDS
+            if f in fields_names and f not in ('tags', 'attachments')
+        ]
+        if 'attachments' in fields_names:
+            read_fields.append('attachment_count')
+        values = dict(
+            (row['id'], row) for row in cls.read(ids, read_fields)
+        )
+
+        tags = defaultdict(list)
+        if 'tags' in fields_names:
+            tag_relations = TaskTags.read(
+                map(int, TaskTags.search([('task', 'in', ids)])),
+                ['task', 'tag']
+            )
+            tag_names = dict(
+                (row['id'], row['name']) for row in Tag.read(
+                    list(set(r['tag'] for r in tag_relations)), ['name']
+                )
+            )
+            for relation in tag_relations:
+                tags[relation['task']].append(tag_names[relation['tag']])
+
+        assignees = {}
+        if 'assigned_to' in fields_names:
+            assignees = dict(
+                (row['id'], {
+                    'id': row['id'],
+                    'display_name': row['display_name'],
+                }) for row in NereidUser.read(
+                    list(set(
+                        v['assigned_to'] for v in values.values()
+                        if v['assigned_to']
+                    )), ['display_name']
+                )
+            )
+
+        result = []
+        for id in ids:
+            value = values[id]
+            value.update({
+                'parent': value.get('parent') or None,
+                # Task specific
+                'tags': tags[id],
+                'assigned_to': assignees.get(value.get('assigned_to')),
+                'attachments': value.get('attachment_count') or 0,
+                'constraint_finish_time': \
+                    value.get('constraint_finish_time') and \
+                    value['constraint_finish_time'].isoformat() or None,
+            })
+            result.append(dict(
+                (name, value[name]) for name in SERIALIZE_FIELDS
+                if name in fields_names
+            ))
+        return result
+
+    @classmethod
+    def stream_serialized(cls, ids, fields_names=None, **extra):
+        """
+        Returns a response streaming a JSON object with the serialized
+        records as ``items`` and the extra keyword arguments as other keys.
+        Records are read and serialized in batches while the response is
+        sent, so the memory used does not grow with the number of records.
+
+        :param ids: The ids of the records to serialize, in order
+        :param fields_names: The fields to serialize, all by default
+        """
+        database_name = Transaction().cursor.dbname
+        user = Transaction().user
+        context = Transaction().context.copy()
+
+        def generate():
+            # The response is sent after the transaction of the request has
+            # ended, so the records are read in a transaction of their own
+            new_transaction = Transaction().cursor is None
+            if new_transaction:
+                Transaction().start(database_name, user, context=context)
+            try:
+                yield '{"items": ['
+                for i in range(0, len(ids), STREAM_BATCH_SIZE):
+                    items = cls.serialize_many(
+                        cls.browse(ids[i:i + STREAM_BATCH_SIZE]),
+                        fields_names
+                    )
+                    chunk = ', '.join(map(json.dumps, items))
+                    yield i and ', ' + chunk or chunk
+                yield ']'
+                for key, value in extra.iteritems():
+                    yield ', %s: %s' % (json.dumps(key), json.dumps(value))
+                yield '}'
+            finally:
+                if new_transaction:
+                    Transaction().stop()
+
+        return Response(generate(), mimetype='application/json')
+
+    @classmethod
+    def get_serialize_fields(cls):
+        """
+        Returns the fields asked for with the ``fields`` argument of the
+        request, as a comma separated list, or None for all the fields.
+        """
+        fields_names = request.args.get('fields')
+        if not fields_names:
+            return None
+        fields_names = [f.strip() for f in fields_names.split(',')]
+        if set(fields_names) - set(SERIALIZE_FIELDS):
+            abort(400)
+        return fields_names
 
     @classmethod
     def rst_to_html(cls):
@@ -366,21 +917,431 @@ class Project:
     @classmethod
     def get_all_participants(cls, works, name):
         """
-        All participants includes the participants in the project and also
-        the admins
+        All participants includes the participants in the project and its
+        parents and also the admins
         """
+        ProjectMember = Pool().get('project.work.member')
+
+        members = ProjectMember.get_user_ids(works)
         vals = {}
         for work in works:
-            vals[work.id] = []
-            vals[work.id].extend([p.id for p in work.participants])
-            vals[work.id].extend([p.id for p in work.company.project_admins])
-            if work.parent:
-                vals[work.id].extend(
-                    [p.id for p in work.parent.all_participants]
-                )
-            vals[work.id] = list(set(vals[work.id]))
+            vals[work.id] = list(
+                members[work.id] | work.company.get_project_admin_ids()
+            )
         return vals
 
+    @classmethod
+    def search_all_participants(cls, name, clause):
+        """
+        Search on all participants. The clause ``('all_participants', '=',
+        user_id)`` matches the works the user can access, as a member or as
+        an admin of the company, in a single query.
+        """
+        return ['OR',
+            ('members',) + tuple(clause[1:]),
+            ('company.project_admins',) + tuple(clause[1:]),
+        ]
+
+    @classmethod
+    def get_access_domain(cls, user):
+        """
+        Returns the domain to restrict a search to the works the given nereid
+        user can access. Project admins can access all the works.
+
+        :param user: The browse record of the nereid user
+        """
+        if user.is_project_admin():
+            return []
+        return [('all_participants', '=', user.id)]
+
+    @classmethod
+    def update_search_text(cls, works):
+        """
+        Rebuild the full text search document of the given works from their
+        name, description and history comments, archived or not.
+        """
+        History = Pool().get('project.work.history')
+        Archive = Pool().get('project.work.history.archive')
+        cursor = Transaction().cursor
+
+        works = cls.browse(map(int, works))
+        comments = defaultdict(list)
+        for model in (Archive, History):
+            for line in model.search([
+                    ('project', 'in', map(int, works)),
+                    ('comment', '!=', None),
+                    ], order=[('id', 'ASC')]):
+                comments[line.project.id].append(line.comment)
+
+        for work in works:
+            text = '\n'.join(
+                filter(None, [work.name, work.comment] + comments[work.id])
+            )
+            cursor.execute(
+                'UPDATE "' + cls._table + '" SET "search_text" = %s '
+                'WHERE "id" = %s', (text, work.id)
+            )
+
+    @classmethod
+    def append_search_text(cls, work_id, text):
+        """
+        Append text to the full text search document of a work. This is
+        cheaper than a rebuild when a comment is added.
+        """
+        cursor = Transaction().cursor
+
+        cursor.execute(
+            'UPDATE "' + cls._table + '" '
+            'SET "search_text" = COALESCE("search_text", \'\') || %s '
+            'WHERE "id" = %s', ('\n' + text, work_id)
+        )
+
+    @classmethod
+    def get_fulltext_query(cls, query, domain):
+        """
+        Returns the SQL query selecting the ids and rank of the works
+        matching the domain and the full text query, with its arguments. On
+        PostgreSQL this uses the full text index, other backends fall back
+        to a substring match.
+
+        :param query: The text typed by the user
+        :param domain: The domain which the works must also match
+        """
+        domain_query, domain_args = cls.search(
+            domain, order=[], query_string=True
+        )
+        if CONFIG['db_type'] == 'postgresql':
+            return (
+                'SELECT "id", ts_rank(' + FTS_VECTOR + ', "query") AS "rank" '
+                'FROM "' + cls._table + '", '
+                'plainto_tsquery(\'' + FTS_CONFIG + '\', %s) AS "query" '
+                'WHERE ' + FTS_VECTOR + ' @@ "query" '
+                'AND "id" IN (' + domain_query + ')',
+                [query] + list(domain_args)
+            )
+        return (
+            'SELECT "id", 0 AS "rank" FROM "' + cls._table + '" '
+            'WHERE "search_text" LIKE %s '
+            'AND "id" IN (' + domain_query + ')',
+            ['%' + query + '%'] + list(domain_args)
+        )
+
+    @classmethod
+    def search_fulltext(cls, query, domain, offset=0, limit=None):
+        """
+        Returns the ids of the works matching the domain and the full text
+        query, best match first.
+
+        :param query: The text typed by the user
+        :param domain: The domain which the works must also match
+        :param offset: The number of matches skipped
+        :param limit: The maximum number of ids returned
+        """
+        cursor = Transaction().cursor
+
+        fulltext_query, args = cls.get_fulltext_query(query, domain)
+        limit_clause = ''
+        if limit is not None:
+            limit_clause = ' LIMIT %s OFFSET %s'
+            args = args + [limit, offset]
+        cursor.execute(
+            'SELECT "id" FROM (' + fulltext_query + ') AS "matches" '
+            'ORDER BY "rank" DESC, "id" DESC' + limit_clause, args
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+    @classmethod
+    def get_facet_counts(cls, domain, query=None):
+        """
+        Returns the number of tasks matching the domain by state, progress
+        state, assignee and tag, computed with a single grouped query.
+
+        The result is a dictionary with the keys ``opened_tasks_count``,
+        ``done_tasks_count`` and ``all_tasks_count`` and the facet
+        dictionaries ``state``, ``progress_state``, ``assigned_to`` and
+        ``tags`` mapping each value to its count.
+
+        :param domain: The domain of the tasks to count
+        :param query: A full text query the tasks must also match
+        """
+        TaskTags = Pool().get('project.work-project.work.tag')
+        cursor = Transaction().cursor
+
+        if query:
+            domain_query, domain_args = cls.get_fulltext_query(query, domain)
+            domain_query = 'SELECT "id" FROM (' + domain_query + \
+                ') AS "matches"'
+        else:
+            domain_query, domain_args = cls.search(
+                domain, order=[], query_string=True
+            )
+        domain_args = list(domain_args)
+        cursor.execute(
+            'SELECT \'state\', "state", CAST(NULL AS INTEGER), COUNT(*) '
+            'FROM "' + cls._table + '" '
+            'WHERE "id" IN (' + domain_query + ') GROUP BY "state" '
+            'UNION ALL '
+            'SELECT \'progress_state\', "progress_state", '
+            'CAST(NULL AS INTEGER), COUNT(*) '
+            'FROM "' + cls._table + '" '
+            'WHERE "id" IN (' + domain_query + ') GROUP BY "progress_state" '
+            'UNION ALL '
+            'SELECT \'assigned_to\', NULL, "assigned_to", COUNT(*) '
+            'FROM "' + cls._table + '" '
+            'WHERE "id" IN (' + domain_query + ') GROUP BY "assigned_to" '
+            'UNION ALL '
+            'SELECT \'tags\', NULL, "tag", COUNT(*) '
+            'FROM "' + TaskTags._table + '" '
+            'WHERE "task" IN (' + domain_query + ') GROUP BY "tag"',
+            domain_args * 4
+        )
+
+        facets = {
+            'state': {},
+            'progress_state': {},
+            'assigned_to': {},
+            'tags': {},
+        }
+        for facet, value, value_id, count in cursor.fetchall():
+            facets[facet][value if value_id is None else value_id] = count
+
+        counts = {
+            'opened_tasks_count': facets['state'].get('opened', 0),
+            'done_tasks_count': facets['state'].get('done', 0),
+            'all_tasks_count': sum(facets['state'].values()),
+        }
+        counts.update(facets)
+        return counts
+
+    @classmethod
+    def update_counters(cls, work_ids):
+        """
+        Recompute the comment and attachment counters of the given works
+        with a single update statement.
+
+        The counters are recomputed rather than incremented, so concurrent
+        changes to the same work cannot leave a wrong count behind.
+
+        :param work_ids: list of ids of project.work
+        """
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+        History = pool.get('project.work.history')
+        Archive = pool.get('project.work.history.archive')
+        cursor = Transaction().cursor
+
+        work_ids = list(set(filter(None, work_ids)))
+        table = '"' + cls._table + '"'
+        for i in range(0, len(work_ids), cursor.IN_MAX):
+            sub_ids = work_ids[i:i + cursor.IN_MAX]
+            cursor.execute(
+                'UPDATE ' + table + ' SET '
+                '"comment_count" = (SELECT COUNT(*) '
+                    'FROM "' + History._table + '" '
+                    'WHERE "project" = ' + table + '."id") + '
+                    '(SELECT COUNT(*) '
+                    'FROM "' + Archive._table + '" '
+                    'WHERE "project" = ' + table + '."id"), '
+                '"attachment_count" = (SELECT COUNT(*) '
+                    'FROM "' + Attachment._table + '" '
+                    'WHERE "resource" = %s || '
+                    'CAST(' + table + '."id" AS VARCHAR)) '
+                'WHERE "id" IN (' + ','.join(('%s',) * len(sub_ids)) + ')',
+                [cls.__name__ + ','] + sub_ids
+            )
+
+    @classmethod
+    def get_etag(cls, domain):
+        """
+        Returns an entity tag for the current user's view of the works
+        matching the domain.
+
+        The tag changes whenever one of the works, their history,
+        timesheet lines, attachments, commits, participants, members or
+        tags is created, changed or deleted, and when a tag or a user shown
+        as member, assignee or author of an update is changed. It is
+        computed from the latest write date and the number of records of
+        each source in a single query, so that an unchanged page can be
+        answered without loading any record.
+
+        Other records rendered by the pages, like the project admins who
+        are not members, are not part of the tag.
+
+        :param domain: The domain of the works shown by the page
+        """
+        pool = Pool()
+        TimesheetWork = pool.get('timesheet.work')
+        TimesheetLine = pool.get('timesheet.line')
+        Attachment = pool.get('ir.attachment')
+        History = pool.get('project.work.history')
+        Commit = pool.get('project.work.commit')
+        ProjectUsers = pool.get('project.work-nereid.user')
+        ProjectMember = pool.get('project.work.member')
+        TaskTags = pool.get('project.work-project.work.tag')
+        Tag = pool.get('project.work.tag')
+        NereidUser = pool.get('nereid.user')
+        cursor = Transaction().cursor
+
+        domain_query, domain_args = cls.search(
+            domain, order=[], query_string=True
+        )
+        domain_args = list(domain_args)
+        last_modified = \
+            'MAX(COALESCE("write_date", "create_date")), COUNT(*) '
+        cursor.execute(
+            'SELECT ' + last_modified + 'FROM "' + cls._table + '" '
+            'WHERE "id" IN (' + domain_query + ') '
+            'UNION ALL '
+            'SELECT ' + last_modified + 'FROM "' + TimesheetWork._table + '" '
+            'WHERE "id" IN (SELECT "work" FROM "' + cls._table + '" '
+                'WHERE "id" IN (' + domain_query + ')) '
+            'UNION ALL '
+            'SELECT ' + last_modified + 'FROM "' + History._table + '" '
+            'WHERE "project" IN (' + domain_query + ') '
+            'UNION ALL '
+            'SELECT ' + last_modified + 'FROM "' + TimesheetLine._table + '" '
+            'WHERE "work" IN (SELECT "work" FROM "' + cls._table + '" '
+                'WHERE "id" IN (' + domain_query + ')) '
+            'UNION ALL '
+            'SELECT ' + last_modified + 'FROM "' + Attachment._table + '" '
+            'WHERE "resource" IN (SELECT \'' + cls.__name__ + ',\' || '
+                'CAST("id" AS VARCHAR) FROM "' + cls._table + '" '
+                'WHERE "id" IN (' + domain_query + ')) '
+            'UNION ALL '
+            'SELECT ' + last_modified + 'FROM "' + Commit._table + '" '
+            'WHERE "project" IN (' + domain_query + ') '
+            'UNION ALL '
+            'SELECT ' + last_modified + 'FROM "' + ProjectUsers._table + '" '
+            'WHERE "project" IN (' + domain_query + ') '
+            'UNION ALL '
+            'SELECT ' + last_modified + 'FROM "' + ProjectMember._table + '" '
+            'WHERE "work" IN (' + domain_query + ') '
+            'UNION ALL '
+            'SELECT ' + last_modified + 'FROM "' + TaskTags._table + '" '
+            'WHERE "task" IN (' + domain_query + ') '
+            'UNION ALL '
+            'SELECT ' + last_modified + 'FROM "' + Tag._table + '" '
+            'WHERE "project" IN (' + domain_query + ') '
+                'OR "id" IN (SELECT "tag" FROM "' + TaskTags._table + '" '
+                'WHERE "task" IN (' + domain_query + ')) '
+            'UNION ALL '
+            'SELECT ' + last_modified + 'FROM "' + NereidUser._table + '" '
+            'WHERE "id" IN (SELECT "user" FROM "' + ProjectMember._table +
+                '" WHERE "work" IN (' + domain_query + ')) '
+                'OR "id" IN (SELECT "assigned_to" FROM "' + cls._table +
+                '" WHERE "id" IN (' + domain_query + ')) '
+                'OR "id" IN (SELECT "updated_by" FROM "' + History._table +
+                '" WHERE "project" IN (' + domain_query + '))',
+            domain_args * 14
+        )
+
+        # The same works look different to other users, in other languages
+        # and as JSON or HTML
+        key = [
+            cursor.dbname, request.nereid_user.id, request.url,
+            request.is_xhr, Transaction().language,
+        ]
+        key.extend(
+            (last_date and str(last_date), count)
+            for last_date, count in cursor.fetchall()
+        )
+        return hashlib.sha1(repr(key)).hexdigest()
+
+    @classmethod
+    def not_modified(cls, etag):
+        """
+        Returns a 304 response if the client already has the version of the
+        page identified by the etag, None otherwise.
+
+        :param etag: Entity tag of the page as returned by
+                     :meth:`get_etag`
+        """
+        if '_flashes' in session:
+            # The page has to be rendered to show the pending messages
+            return None
+        if etag in request.if_none_match:
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+    @classmethod
+    def with_etag(cls, rv, etag):
+        """
+        Returns the response of a view with the entity tag set, so that the
+        next request for the page can be made conditional. Pages showing
+        flashed messages get no tag.
+
+        :param rv: The return value of the view
+        :param etag: Entity tag of the page as returned by
+                     :meth:`get_etag`
+        """
+        response = make_response(rv)
+        # A page showing flashed messages must not be reused later
+        if '_flashes' not in session and \
+                not _request_ctx_stack.top.flashes:
+            response.set_etag(etag)
+        # Clients have to revalidate, the page differs between users
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+
+    @classmethod
+    @login_required
+    def typeahead(cls):
+        """
+        Returns the tasks accessible to the user whose name matches the
+        typed text as JSON, for quick navigation. A text like ``#1234`` is
+        looked up as the id of the task.
+        """
+        query = request.args.get('q', '').strip()
+        limit = max(min(
+            request.args.get('limit', TYPEAHEAD_LIMIT, int),
+            5 * TYPEAHEAD_LIMIT
+        ), 1)
+        if not query:
+            return jsonify(items=[])
+
+        key = key_from_list([
+            Transaction().cursor.dbname,
+            request.nereid_user.id,
+            'project.work.typeahead',
+            query.lower(),
+            limit,
+        ])
+        items = cache.get(key)
+        if items is not None:
+            return jsonify(items=items)
+
+        domain = [
+            ('type', '=', 'task'),
+        ] + cls.get_access_domain(request.nereid_user)
+
+        match = re.match(r'^#(\d+)$', query)
+        if match:
+            tasks = cls.search(
+                domain + [('id', '=', int(match.group(1)))], limit=1
+            )
+        else:
+            # The typed text is matched literally
+            pattern = query.replace('\\', '\\\\').replace(
+                '%', '\\%').replace('_', '\\_')
+            tasks = cls.search(
+                domain + [('name', 'ilike', '%' + pattern + '%')],
+                order=[('state', 'DESC'), ('id', 'DESC')], limit=limit
+            )
+
+        items = [{
+            'id': task.id,
+            'name': task.name,
+            'state': task.state,
+            'url': url_for(
+                'project.work.render_task',
+                project_id=task.parent.id, task_id=task.id
+            ),
+        } for task in tasks]
+        cache.set(key, items, TYPEAHEAD_CACHE_TIMEOUT)
+        return jsonify(items=items)
+
     @classmethod
     def create(cls, values):
         '''
@@ -398,7 +1359,12 @@ class Project:
         else:
             # TODO: identify the nereid user through employee
             pass
-        return super(Project, cls).create(values)
+        ProjectMember = Pool().get('project.work.member')
+
+        project = super(Project, cls).create(values)
+        ProjectMember.update_members([project])
+        cls.update_search_text([project])
+        return project
 
     def can_read(self, user):
         """
@@ -408,7 +1374,10 @@ class Project:
         """
         if user.is_project_admin():
             return True
-        if not user in self.participants:
+        if not self.search([
+                ('id', '=', self.id),
+                ('members', '=', user.id),
+                ], count=True):
             raise abort(404)
         return True
 
@@ -420,7 +1389,10 @@ class Project:
         """
         if user.is_project_admin():
             return True
-        if not user in self.participants:
+        if not self.search([
+                ('id', '=', self.id),
+                ('members', '=', user.id),
+                ], count=True):
             raise abort(404)
         return True
 
@@ -432,19 +1404,17 @@ class Project:
 
         :param project_id: Project Id of project to fetch.
         """
-        project, = cls.search([
+        # The access check is a part of the search, so a project the user
+        # is not allowed to access is the same as a missing one
+        projects = cls.search([
             ('id', '=', project_id),
             ('type', '=', 'project'),
-        ])
-
-        if not project:
-            raise abort(404)
+        ] + cls.get_access_domain(request.nereid_user), limit=1)
 
-        if not project.can_read(request.nereid_user):
-            # If the user is not allowed to access this project then dont let
+        if not projects:
             raise abort(404)
 
-        return project
+        return projects[0]
 
     @classmethod
     def get_task(cls, task_id):
@@ -454,19 +1424,16 @@ class Project:
 
         :param task_id: Task Id of project to fetch.
         """
-        task, = cls.search([
+        # The members of a task include the participants of its project
+        tasks = cls.search([
             ('id', '=', task_id),
             ('type', '=', 'task'),
-        ])
+        ] + cls.get_access_domain(request.nereid_user), limit=1)
 
-        if not task:
+        if not tasks:
             raise abort(404)
 
-        if not task.parent.can_write(request.nereid_user):
-            # If the user is not allowed to access this project then dont let
-            raise abort(403)
-
-        return task
+        return tasks[0]
 
     @classmethod
     def get_tasks_by_tag(cls, tag_id):
@@ -602,6 +1569,8 @@ class Project:
 
         :param receivers: Receivers of email.
         """
+        Outbox = Pool().get('project.mail.outbox')
+
         subject = "[#%s %s] - %s" % (
             self.id, self.parent.name, self.name
         )
@@ -615,22 +1584,20 @@ class Project:
         if not receivers:
             return
 
-        message = render_email(
-            from_email=CONFIG['smtp_from'],
-            to=', '.join(receivers),
-            subject=subject,
-            text_template='project/emails/project_text_content.jinja',
-            html_template='project/emails/project_html_content.jinja',
-            task=self,
-            updated_by=request.nereid_user.name
+        context = {
+            'task': self,
+            'updated_by': request.nereid_user.name,
+        }
+        Outbox.queue_shared(
+            receivers, subject,
+            Outbox.render(
+                'project/emails/project_text_content.jinja', **context
+            ),
+            Outbox.render(
+                'project/emails/project_html_content.jinja', **context
+            ),
         )
 
-        #Send mail.
-        server = get_smtp_server()
-        server.sendmail(CONFIG['smtp_from'], receivers,
-            message.as_string())
-        server.quit()
-
     @classmethod
     @login_required
     def unwatch(cls, task_id):
@@ -712,6 +1679,7 @@ class Project:
         """
         NereidUser = Pool().get('nereid.user')
         ProjectInvitation = Pool().get('project.work.invitation')
+        Outbox = Pool().get('project.mail.outbox')
 
         if not request.method == 'POST':
             return abort(404)
@@ -759,10 +1727,7 @@ class Project:
             )
             flash_message = "%s has been invited to the project" % email
 
-        server = get_smtp_server()
-        server.sendmail(CONFIG['smtp_from'], [email],
-            email_message.as_string())
-        server.quit()
+        Outbox.queue([email], email_message)
 
         if request.is_xhr:
             return jsonify({
@@ -782,25 +1747,46 @@ class Project:
             return redirect(request.referrer)
 
         if request.method == 'POST' and request.is_xhr:
-            records_to_update_ids = [self.id]
-            records_to_update_ids.extend([child.id for child in self.children])
-            # If this participant is assigned to any task in this project,
-            # that user cannot be removed as tryton's domain does not permit
-            # this.
-            # So removing assigned user from those tasks as well.
-            # TODO: Find a better way to do it, this is memory intensive
-            assigned_to_participant = self.search([
-                ('id', 'in', records_to_update_ids),
-                ('assigned_to', '=', participant_id)
-            ])
-            self.write(assigned_to_participant, {
-                'assigned_to': False,
-            })
-            self.write(
-                map(
-                    lambda rec_id:
-                        self.__class__(rec_id), records_to_update_ids
-                ), {'participants': [('unlink', [participant_id])]}
+            ParticipantRemoval = Pool().get('project.work.participant.removal')
+
+            with Transaction().set_context(active_test=False):
+                task_count = self.search(
+                    self.get_participant_tasks_domain(participant_id),
+                    count=True
+                )
+
+            # Cut the access to the project right away. If this participant
+            # is assigned to any task in this project, that user cannot be
+            # removed as tryton's domain does not permit this. So the
+            # assigned user is cleared from those tasks as well.
+            if task_count > PARTICIPANT_REMOVAL_BATCH:
+                # Too many tasks to do it within the request
+                self.remove_participant_from_works([self.id], participant_id)
+                removal = ParticipantRemoval.create({
+                    'project': self.id,
+                    'participant': participant_id,
+                    'removed_by': request.nereid_user.id,
+                    'total': task_count,
+                })
+                return jsonify({
+                    'success': True,
+                    'removal': removal.id,
+                    'progress_url': url_for(
+                        'project.work.participant.removal.render_progress',
+                        active_id=removal.id
+                    ),
+                })
+
+            with Transaction().set_context(active_test=False):
+                task_ids = map(int, self.search(
+                    self.get_participant_tasks_domain(participant_id)
+                ))
+            # The members of the project and its tasks are updated at once
+            self.remove_participant_from_works(
+                [self.id] + task_ids, participant_id
+            )
+            self.create_participant_removal_history(
+                participant_id, request.nereid_user.id, len(task_ids)
             )
 
             return jsonify({
@@ -810,6 +1796,72 @@ class Project:
         flash("Could not remove participant! Try again.")
         return redirect(request.referrer)
 
+    def get_participant_tasks_domain(self, participant_id):
+        """
+        Returns the domain for the tasks of the project which the
+        participant watches or is assigned to.
+        """
+        return [
+            ('type', '=', 'task'),
+            ('parent', '=', self.id),
+            ['OR',
+                ('participants', '=', participant_id),
+                ('assigned_to', '=', participant_id),
+            ],
+        ]
+
+    @classmethod
+    def remove_participant_from_works(cls, work_ids, participant_id):
+        """
+        Remove the participant from the given works with set based updates.
+        The works assigned to the participant are unassigned. This does not
+        go through write and does not create history lines.
+
+        :param work_ids: List of ids of works
+        :param participant_id: ID of the nereid user to remove
+        """
+        ProjectUsers = Pool().get('project.work-nereid.user')
+        ProjectMember = Pool().get('project.work.member')
+        cursor = Transaction().cursor
+
+        now = datetime.utcnow()
+        user = Transaction().user
+        for i in range(0, len(work_ids), cursor.IN_MAX):
+            sub_ids = work_ids[i:i + cursor.IN_MAX]
+            in_clause = ','.join(('%s',) * len(sub_ids))
+            cursor.execute(
+                'UPDATE "' + cls._table + '" '
+                'SET "assigned_to" = NULL, "write_uid" = %s, '
+                '"write_date" = %s '
+                'WHERE "assigned_to" = %s AND "id" IN (' + in_clause + ')',
+                [user, now, participant_id] + sub_ids
+            )
+            cursor.execute(
+                'DELETE FROM "' + ProjectUsers._table + '" '
+                'WHERE "user" = %s AND "project" IN (' + in_clause + ')',
+                [participant_id] + sub_ids
+            )
+        ProjectMember.update_members(cls.browse(work_ids))
+
+    def create_participant_removal_history(self, participant_id,
+            removed_by_id, task_count):
+        """
+        Record a single history line on the project summarising the removal
+        of a participant.
+        """
+        NereidUser = Pool().get('nereid.user')
+        History = Pool().get('project.work.history')
+
+        participant = NereidUser(participant_id)
+        return History.create({
+            'project': self.id,
+            'updated_by': removed_by_id,
+            'comment': '%s has been removed from the project and %d %s' % (
+                participant.display_name, task_count,
+                task_count == 1 and 'task' or 'tasks',
+            ),
+        })
+
     @classmethod
     @login_required
     def render_task_list(cls, project_id):
@@ -817,21 +1869,26 @@ class Project:
         Renders a project's task list page
         """
         project = cls.get_project(project_id)
+
+        etag = cls.get_etag([
+            'OR',
+            ('id', '=', project.id),
+            ('parent', '=', project.id),
+        ])
+        not_modified = cls.not_modified(etag)
+        if not_modified:
+            return not_modified
+
         state = request.args.get('state', None)
         page = request.args.get('page', 1, int)
+        if page < 1:
+            abort(400)
 
         filter_domain = [
             ('type', '=', 'task'),
             ('parent', '=', project.id),
         ]
 
-        query = request.args.get('q', None)
-        if query:
-            # This search is probably the suckiest search in the
-            # history of mankind in terms of scalability and utility
-            # TODO: Figure out something better
-            filter_domain.append(('name', 'ilike', '%%%s%%' % query))
-
         tag = request.args.get('tag', None, int)
         if tag:
             filter_domain.append(('tags', '=', tag))
@@ -840,33 +1897,146 @@ class Project:
         if user:
             filter_domain.append(('assigned_to', '=', user))
 
-        counts = {}
-        counts['opened_tasks_count'] = cls.search(
-            filter_domain + [('state', '=', 'opened')], count=True
-        )
-        counts['done_tasks_count'] = cls.search(
-            filter_domain + [('state', '=', 'done')], count=True
-        )
-        counts['all_tasks_count'] = cls.search(
-            filter_domain, count=True
-        )
+        query = request.args.get('q', None)
+        counts = cls.get_facet_counts(filter_domain, query)
 
         if state and state in ('opened', 'done'):
             filter_domain.append(('state', '=', state))
 
-        if request.is_xhr:
-            tasks = cls.search(filter_domain)
-            return jsonify({
-                'items': map(lambda task: task.serialize(), tasks),
-                'domain': filter_domain,
-            })
+        if query:
+            # Paginate the matches in the order of their rank, the number of
+            # matches is known from the counts
+            tasks = RankedPagination(
+                cls, query, filter_domain, page, TASKS_PER_PAGE,
+                counts['%s_tasks_count' % (
+                    state if state in ('opened', 'done') else 'all'
+                )]
+            )
+            if request.is_xhr:
+                return cls.with_etag(jsonify({
+                    'items': cls.serialize_many(
+                        list(tasks), cls.get_serialize_fields()
+                    ),
+                    'count': tasks.count,
+                    'page': page,
+                    'pages': tasks.pages,
+                    'counts': counts,
+                    'domain': filter_domain,
+                }), etag)
+            next_cursor = None
+        elif request.is_xhr and request.args.get('stream'):
+            # All the tasks, serialized while they are sent
+            return cls.with_etag(cls.stream_serialized(
+                map(int, cls.search(filter_domain, order=[('id', 'DESC')])),
+                cls.get_serialize_fields(), counts=counts, domain=filter_domain
+            ), etag)
+        else:
+            # Keyset pagination, deep pages cost the same as the first one
+            order = request.args.get('order', 'id')
+            if order not in ('id', 'updated'):
+                abort(400)
+            try:
+                limit = int(request.args.get('limit', TASKS_PER_PAGE))
+            except ValueError:
+                abort(400)
+            if limit < 1:
+                abort(400)
+            tasks, next_cursor = cls.search_keyset(
+                filter_domain, order, request.args.get('cursor'), limit
+            )
+            if request.is_xhr:
+                return cls.with_etag(jsonify({
+                    'items': cls.serialize_many(
+                        list(tasks), cls.get_serialize_fields()
+                    ),
+                    'next': next_cursor,
+                    'counts': counts,
+                    'domain': filter_domain,
+                }), etag)
 
-        tasks = Pagination(cls, filter_domain, page, 10)
-        return render_template(
+        return cls.with_etag(render_template(
             'project/project-task-list.jinja', project=project,
             active_type_name='render_task_list', counts=counts,
-            state_filter=state, tasks=tasks
-        )
+            state_filter=state, tasks=tasks, next_cursor=next_cursor
+        ), etag)
+
+    @classmethod
+    def search_keyset(cls, domain, order='id', cursor=None, limit=None):
+        """
+        Search with keyset (cursor) pagination, newest first. Returns the
+        records of the page and the cursor of the next page, which is None
+        on the last page.
+
+        :param domain: The search domain
+        :param order: ``id`` to order by id or ``updated`` to order by
+                      (write_date, id). Records never written come last.
+        :param cursor: The cursor returned with the previous page
+        :param limit: The number of records in a page, at most
+                      MAX_TASKS_PER_PAGE
+        """
+        limit = min(limit or TASKS_PER_PAGE, MAX_TASKS_PER_PAGE)
+        write_date, last_id = None, None
+        if cursor:
+            try:
+                write_date, last_id = json.loads(
+                    base64.urlsafe_b64decode(str(cursor))
+                )
+                last_id = int(last_id)
+                if write_date is not None:
+                    write_date = datetime.strptime(
+                        write_date, '%Y-%m-%d %H:%M:%S.%f'
+                    )
+            except (TypeError, ValueError):
+                abort(400)
+
+        records = []
+        if order == 'updated':
+            if last_id is None or write_date is not None:
+                keyset_domain = []
+                if write_date is not None:
+                    keyset_domain = [['OR',
+                        ('write_date', '<', write_date),
+                        [
+                            ('write_date', '=', write_date),
+                            ('id', '<', last_id),
+                        ],
+                    ]]
+                records = cls.search(
+                    domain + [('write_date', '!=', None)] + keyset_domain,
+                    order=[('write_date', 'DESC'), ('id', 'DESC')],
+                    limit=limit + 1
+                )
+            if len(records) <= limit:
+                # Continue with the records which were never written
+                keyset_domain = []
+                if last_id is not None and write_date is None:
+                    keyset_domain = [('id', '<', last_id)]
+                records += cls.search(
+                    domain + [('write_date', '=', None)] + keyset_domain,
+                    order=[('id', 'DESC')], limit=limit + 1 - len(records)
+                )
+        else:
+            keyset_domain = []
+            if last_id is not None:
+                keyset_domain = [('id', '<', last_id)]
+            records = cls.search(
+                domain + keyset_domain, order=[('id', 'DESC')],
+                limit=limit + 1
+            )
+
+        next_cursor = None
+        if len(records) > limit:
+            records = records[:limit]
+            last = records[-1]
+            last_write_date = None
+            if order == 'updated' and last.write_date:
+                last_write_date = last.write_date.strftime(
+                    '%Y-%m-%d %H:%M:%S.%f'
+                )
+            next_cursor = base64.urlsafe_b64encode(
+                json.dumps([last_write_date, last.id])
+            )
+        return records, next_cursor
 
     @classmethod
     @login_required
@@ -880,30 +2050,35 @@ class Project:
             ('type', '=', 'task'),
             ('assigned_to', '=', request.nereid_user.id)
         ]
-        query = request.args.get('q', None)
-        if query:
-            # This search is probably the suckiest search in the
-            # history of mankind in terms of scalability and utility
-            # TODO: Figure out something better
-            filter_domain.append(('name', 'ilike', '%%%s%%' % query))
-
         tag = request.args.get('tag', None, int)
         if tag:
             filter_domain.append(('tags', '=', tag))
 
-        counts = {}
-        counts['opened_tasks_count'] = cls.search(
-            filter_domain + [('state', '=', 'opened')], count=True
-        )
+        query = request.args.get('q', None)
+        counts = cls.get_facet_counts(filter_domain, query)
 
         if state and state in ('opened', 'done'):
             filter_domain.append(('state', '=', state))
 
-        tasks = cls.search(filter_domain, order=[('progress_state', 'ASC')])
+        if query:
+            # Best matches first
+            tasks = cls.browse(cls.search_fulltext(query, filter_domain))
+        else:
+            tasks = cls.search(
+                filter_domain, order=[('progress_state', 'ASC')]
+            )
 
         if request.is_xhr:
+            if request.args.get('stream'):
+                return cls.stream_serialized(
+                    map(int, tasks), cls.get_serialize_fields(),
+                    counts=counts, domain=filter_domain
+                )
             return jsonify({
-                'items': map(lambda task: task.serialize(), tasks),
+                'items': cls.serialize_many(
+                    list(tasks), cls.get_serialize_fields()
+                ),
+                'counts': counts,
                 'domain': filter_domain,
             })
 
@@ -924,40 +2099,231 @@ class Project:
         """
         Renders the task in a project
         """
-        task = cls.get_task(task_id)
+        Archive = Pool().get('project.work.history.archive')
 
-        comments = sorted(
-            task.history + task.timesheet_lines + task.attachments + \
-                task.repo_commits, key=lambda x: x.create_date
-        )
+        task = cls.get_task(task_id)
 
-        hours={}
-        for line in task.timesheet_lines:
-            hours[line.employee] = hours.setdefault(line.employee, 0) + \
-                    line.hours
+        etag = cls.get_etag([('id', '=', task.id)])
+        not_modified = cls.not_modified(etag)
+        if not_modified:
+            return not_modified
 
         if request.is_xhr:
-            response = cls.serialize(task)
-            return jsonify(response)
+            response = task.serialize(cls.get_serialize_fields())
+            return cls.with_etag(jsonify(response), etag)
 
-        return render_template(
+        comments, timeline_cursor = task.get_timeline()
+        archived_count = Archive.search(
+            [('project', '=', task.id)], count=True
+        )
+
+        return cls.with_etag(render_template(
             'project/task.jinja', task=task, \
             active_type_name='render_task_list', project=task.parent,
-            comments=comments, timesheet_summary=hours
+            comments=comments, timeline_cursor=timeline_cursor,
+            timesheet_summary=task.get_hours_by_employee(),
+            archived_count=archived_count
+        ), etag)
+
+    def get_timeline(self, before=None, limit=TIMELINE_LIMIT):
+        """
+        Returns the latest entries of the timeline of the task, oldest
+        first, and the cursor of the older entries, which is None when
+        there are none.
+
+        The history lines, timesheet lines, attachments and commits of the
+        task are merged, ordered and limited by a single query, and only the
+        entries returned are loaded.
+
+        :param before: The cursor returned with the newer entries
+        :param limit: The number of entries
+        """
+        pool = Pool()
+        History = pool.get('project.work.history')
+        TimesheetLine = pool.get('timesheet.line')
+        Attachment = pool.get('ir.attachment')
+        Commit = pool.get('project.work.commit')
+        cursor = Transaction().cursor
+
+        keyset, keyset_args = '', []
+        if before:
+            try:
+                create_date, model, last_id = json.loads(
+                    base64.urlsafe_b64decode(str(before))
+                )
+                create_date = datetime.strptime(
+                    create_date, '%Y-%m-%d %H:%M:%S.%f'
+                )
+                last_id = int(last_id)
+            except (TypeError, ValueError):
+                abort(400)
+            keyset = (
+                'WHERE "create_date" < %s OR ("create_date" = %s AND '
+                '("model" < %s OR ("model" = %s AND "id" < %s))) '
+            )
+            keyset_args = [create_date, create_date, model, model, last_id]
+
+        sources = [
+            (History, 'project', self.id),
+            (TimesheetLine, 'work', self.work.id),
+            (Attachment, 'resource', '%s,%d' % (self.__name__, self.id)),
+            (Commit, 'project', self.id),
+        ]
+        cursor.execute(
+            'SELECT "model", "id" FROM (' + ' UNION ALL '.join(
+                'SELECT \'' + model.__name__ + '\' AS "model", "id", '
+                '"create_date" FROM "' + model._table + '" '
+                'WHERE "' + column + '" = %s'
+                for model, column, _ in sources
+            ) + ') AS "timeline" ' + keyset +
+            'ORDER BY "create_date" DESC, "model" DESC, "id" DESC LIMIT %s',
+            [value for _, _, value in sources] + keyset_args + [limit + 1]
+        )
+        rows = cursor.fetchall()
+
+        ids = defaultdict(list)
+        for model, record_id in rows[:limit]:
+            ids[model].append(record_id)
+        records = {}
+        for model, record_ids in ids.iteritems():
+            for record in pool.get(model).browse(record_ids):
+                records[(model, record.id)] = record
+        entries = [records[row] for row in reversed(rows[:limit])]
+
+        next_cursor = None
+        if len(rows) > limit:
+            oldest = entries[0]
+            next_cursor = base64.urlsafe_b64encode(json.dumps([
+                oldest.create_date.strftime('%Y-%m-%d %H:%M:%S.%f'),
+                oldest.__name__, oldest.id,
+            ]))
+        return entries, next_cursor
+
+    def get_hours_by_employee(self):
+        """
+        Returns the hours logged on the task by each employee
+        """
+        pool = Pool()
+        TimesheetLine = pool.get('timesheet.line')
+        Employee = pool.get('company.employee')
+        cursor = Transaction().cursor
+
+        cursor.execute(
+            'SELECT "employee", SUM("hours") '
+            'FROM "' + TimesheetLine._table + '" '
+            'WHERE "work" = %s GROUP BY "employee"', (self.work.id,)
+        )
+        return dict(
+            (Employee(employee_id), hours)
+            for employee_id, hours in cursor.fetchall()
+        )
+
+    @classmethod
+    @login_required
+    def render_timeline(cls, task_id):
+        """
+        Renders the entries of the timeline of the task older than the
+        cursor argument, as loaded when the reader asks for older entries.
+        """
+        task = cls.get_task(task_id)
+
+        etag = cls.get_etag([('id', '=', task.id)])
+        not_modified = cls.not_modified(etag)
+        if not_modified:
+            return not_modified
+
+        comments, next_cursor = task.get_timeline(request.args.get('cursor'))
+        html = render_template(
+            'project/timeline.jinja', task=task, comments=comments
+        )
+        if request.is_xhr:
+            return cls.with_etag(jsonify({
+                'html': unicode(html),
+                'count': len(comments),
+                'next': next_cursor,
+            }), etag)
+        return cls.with_etag(html, etag)
+
+    @classmethod
+    @login_required
+    def render_archived_history(cls, task_id):
+        """
+        Renders the archived history lines of the task, which are not shown
+        with the task.
+        """
+        Archive = Pool().get('project.work.history.archive')
+
+        task = cls.get_task(task_id)
+        lines = Archive.search([
+            ('project', '=', task.id),
+        ], order=[('create_date', 'ASC'), ('id', 'ASC')])
+        html = u''.join(
+            unicode(render_template('project/comment.jinja', comment=line))
+            for line in lines
         )
+        if request.is_xhr:
+            return jsonify({
+                'success': True,
+                'count': len(lines),
+                'html': html,
+            })
+        return html
 
     @classmethod
     @login_required
     def render_files(cls, project_id):
+        """
+        Renders the files attached to the project and its tasks, a page at a
+        time. The files are sorted by date, size or name (order argument)
+        and can be restricted to files or links (type argument).
+        """
+        Attachment = Pool().get('ir.attachment')
+
         project = cls.get_project(project_id)
-        other_attachments = chain.from_iterable(
-            [list(task.attachments) for task in project.children if \
-                task.attachments]
+        page = request.args.get('page', 1, int)
+        order = request.args.get('order', 'date')
+        if order not in FILES_ORDER:
+            abort(400)
+        file_type = request.args.get('type')
+        if file_type not in (None, 'data', 'link'):
+            abort(400)
+
+        # The attachments of all the works are fetched by one query a page
+        pagination = FilesPagination(
+            Attachment, project, file_type, order, page, FILES_PER_PAGE
         )
+
+        attachments = list(pagination)
+        work_ids = Attachment.get_work_ids(
+            Attachment.get_resources(attachments)
+        )
+        works = dict((work.id, work) for work in cls.browse(work_ids))
+        files = [
+            (attachment, works[work_id])
+            for attachment, work_id in zip(attachments, work_ids)
+        ]
+
+        if request.is_xhr:
+            return jsonify({
+                'items': [{
+                    'id': attachment.id,
+                    'name': attachment.name,
+                    'type': attachment.type,
+                    'mimetype': guess_type(attachment.name)[0],
+                    'size': attachment.file_size,
+                    'create_date': attachment.create_date.isoformat(),
+                    'work': work.id,
+                } for attachment, work in files],
+                'count': pagination.count,
+                'page': page,
+                'pages': pagination.pages,
+            })
+
         return render_template(
             'project/project-files.jinja', project=project,
             active_type_name='files', guess_type=guess_type,
-            other_attachments=other_attachments
+            pagination=pagination, files=files, order=order,
+            file_type=file_type
         )
 
     @classmethod
@@ -1429,6 +2795,21 @@ class Project:
         Returns the file for download. The ownership of the task or the
         project is checked automatically.
         """
+        attachment = cls.get_attachment(attachment_id)
+
+        if attachment.type == 'link':
+            return redirect(attachment.link)
+
+        return attachment.stream_response()
+
+    @classmethod
+    def get_attachment(cls, attachment_id):
+        """
+        Returns the attachment of the project or task given in the request
+        arguments, after checking the user can access it.
+
+        :param attachment_id: Id of the attachment to fetch
+        """
         Attachment = Pool().get('ir.attachment')
 
         work = None
@@ -1441,23 +2822,52 @@ class Project:
             # Neither task, nor the project is specified
             raise abort(404)
 
-        attachment, = Attachment.search([
+        attachments = Attachment.search([
             ('id', '=', attachment_id),
             ('resource', '=', '%s,%d' % (cls.__name__, work.id))
         ], limit=1)
 
-        if attachment.type == 'link':
-            return redirect(attachment.link)
-
-        if not attachment:
+        if not attachments:
             raise abort(404)
+        return attachments[0]
+
+    @classmethod
+    @login_required
+    def render_thumbnail(cls, attachment_id):
+        """
+        Returns the thumbnail (default) or the preview (size argument) of an
+        image attachment. The images are generated in the background after
+        the upload, until then this is a 404.
+        """
+        Thumbnail = Pool().get('project.work.thumbnail')
 
-        with tempfile.NamedTemporaryFile(delete=False) as f:
-            f.write(attachment.data)
+        size = request.args.get('size', 'thumbnail')
+        if size not in THUMBNAIL_SIZES:
+            abort(400)
 
-        return send_file(
-            f.name, attachment_filename=attachment.name, as_attachment=True
-        )
+        attachment = cls.get_attachment(attachment_id)
+        thumbnails = Thumbnail.search([
+            ('attachment', '=', attachment.id),
+            ('state', '=', 'done'),
+        ], limit=1)
+        if not thumbnails:
+            abort(404)
+        thumbnail, = thumbnails
+
+        path = thumbnail.get_path(size)
+        if not os.path.isfile(path):
+            abort(404)
+
+        etag = '%s-%s' % (thumbnail.key, size)
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            with open(path, 'rb') as image_file:
+                response = Response(image_file.read(), mimetype='image/jpeg')
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.max_age = THUMBNAIL_MAX_AGE
+        return response
 
     @classmethod
     @login_required
@@ -1478,8 +2888,6 @@ class Project:
             # Neither task, nor the project is specified
             raise abort(404)
 
-        attached_file =  request.files["file"]
-
         data = {
             'resource': '%s,%d' % (cls.__name__, work.id),
             'description': request.form.get('description', '')
@@ -1493,13 +2901,24 @@ class Project:
                 'type': 'link'
             })
         else:
+            attached_file = request.files["file"]
+            # The file is copied to the file store in chunks, it is never
+            # entirely in memory
+            values = Attachment.store_file(
+                attached_file.stream, work.get_upload_limit()
+            )
+            if values is None:
+                abort(413)
+            data.update(values)
             data.update({
-                'data': attached_file.stream.read(),
                 'name': attached_file.filename,
                 'type': 'data'
             })
 
-        Attachment.create(data)
+        if data['type'] == 'data':
+            Attachment.create_stored(data)
+        else:
+            Attachment.create(data)
 
         if request.is_xhr:
             return jsonify({
@@ -1509,6 +2928,98 @@ class Project:
         flash("Attachment added to %s" % work.name)
         return redirect(request.referrer)
 
+    @classmethod
+    @login_required
+    def start_upload(cls):
+        """
+        Starts a resumable upload of a file to a project or task. The
+        content is then sent in chunks to the URL of the returned upload
+        (see :meth:`ProjectUpload.upload_chunk`).
+        """
+        Upload = Pool().get('project.work.upload')
+
+        work = None
+        if request.form.get('project', None):
+            work = cls.get_project(request.form.get('project', type=int))
+        if request.form.get('task', None):
+            work = cls.get_task(request.form.get('task', type=int))
+
+        if not work:
+            # Neither task, nor the project is specified
+            raise abort(404)
+
+        size = request.form.get('size', type=int)
+        name = request.form.get('name')
+        if size is None or size < 0 or not name:
+            abort(400)
+
+        limit = work.get_upload_limit()
+        if limit is not None and size > limit:
+            abort(413)
+
+        upload = Upload.create({
+            'work': work.id,
+            'nereid_user': request.nereid_user.id,
+            'name': name,
+            'description': request.form.get('description', ''),
+            'size': size,
+        })
+        return jsonify({
+            'id': upload.id,
+            'url': url_for(
+                'project.work.upload.upload_chunk', active_id=upload.id
+            ),
+            'offset': 0,
+            'chunk_size': RESUMABLE_CHUNK_SIZE,
+        })
+
+    def get_storage_used(self):
+        """
+        Returns the size in bytes of the files attached to the project and
+        its tasks.
+        """
+        Attachment = Pool().get('ir.attachment')
+        cursor = Transaction().cursor
+
+        domain_query, domain_args = self.search([
+            'OR',
+            ('id', '=', self.id),
+            ('parent', '=', self.id),
+        ], order=[], query_string=True)
+        cursor.execute(
+            'SELECT COALESCE(SUM("file_size"), 0) '
+            'FROM "' + Attachment._table + '" '
+            'WHERE "resource" IN (SELECT %s || CAST("id" AS VARCHAR) '
+                'FROM "' + self._table + '" '
+                'WHERE "id" IN (' + domain_query + '))',
+            [self.__name__ + ','] + list(domain_args)
+        )
+        return cursor.fetchone()[0]
+
+    def get_upload_limit(self):
+        """
+        Returns the maximum size in bytes of a file uploaded to the work,
+        None if there is no limit. This is the smallest of the maximum file
+        size and the storage left in the project.
+        """
+        limits = []
+        max_file_size = int(
+            CONFIG.get('project_max_file_size', MAX_FILE_SIZE) or 0
+        )
+        if max_file_size:
+            limits.append(max_file_size)
+
+        max_storage = int(
+            CONFIG.get('project_max_storage', MAX_PROJECT_STORAGE) or 0
+        )
+        if max_storage:
+            project = self.type == 'project' and self or self.parent
+            limits.append(max(max_storage - project.get_storage_used(), 0))
+
+        if not limits:
+            return None
+        return min(limits)
+
     @classmethod
     @login_required
     def update_task(cls, task_id):
@@ -1659,11 +3170,16 @@ class Project:
         :param values: A dictionary
         """
         WorkHistory = Pool().get('project.work.history')
+        ProjectMember = Pool().get('project.work.member')
 
-        for project in projects:
-            WorkHistory.create_history_line(project, values)
+        WorkHistory.create_history_lines(projects, values)
 
-        return super(Project, cls).write(projects, values)
+        rv = super(Project, cls).write(projects, values)
+        if 'parent' in values:
+            ProjectMember.update_members(projects)
+        if 'name' in values or 'comment' in values:
+            cls.update_search_text(projects)
+        return rv
 
     @classmethod
     @login_required
@@ -1983,6 +3499,28 @@ class ProjectHistory(ModelSQL, ModelView):
     previous_constraint_finish_time = fields.DateTime("Constraint Finish Time")
     new_constraint_finish_time = fields.DateTime("Constraint  Finish Time")
 
+    # The update as rendered in digests and quoted in the mails of later
+    # updates, rendered once for all the mails
+    digest_text = fields.Text('Digest Text', readonly=True)
+    digest_html = fields.Text('Digest HTML', readonly=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        Project = Pool().get('project.work')
+
+        super(ProjectHistory, cls).__register__(module_name)
+
+        table = TableHandler(Transaction().cursor, cls, module_name)
+        table.index_action(['project', 'id'], 'add')
+        table.index_action(['project', 'create_date'], 'add')
+
+        # Build the full text search documents of the works which do not
+        # have one yet. This needs the history table, hence done here.
+        with Transaction().set_context(active_test=False):
+            Project.update_search_text(
+                Project.search([('search_text', '=', None)])
+            )
+
     @staticmethod
     def default_date():
         '''
@@ -1991,30 +3529,101 @@ class ProjectHistory(ModelSQL, ModelView):
         return datetime.utcnow()
 
     @classmethod
-    def create_history_line(cls, project, changed_values):
+    def create(cls, values):
+        Project = Pool().get('project.work')
+
+        history = super(ProjectHistory, cls).create(values)
+        if history.project:
+            Project.update_counters([history.project.id])
+        if history.comment and history.project:
+            Project.append_search_text(history.project.id, history.comment)
+        return history
+
+    @classmethod
+    def write(cls, lines, values):
+        Project = Pool().get('project.work')
+
+        work_ids = [l.project.id for l in lines if l.project]
+        if 'comment' in values:
+            # The rendering of the updates has to be done again
+            values = values.copy()
+            values.update({
+                'digest_text': None,
+                'digest_html': None,
+            })
+        rv = super(ProjectHistory, cls).write(lines, values)
+        if 'project' in values:
+            Project.update_counters(work_ids + [values['project']])
+        if 'comment' in values:
+            Project.update_search_text(
+                [l.project for l in lines if l.project]
+            )
+            if has_request_context():
+                # Queued digests and later mails use the new rendering
+                for line in cls.browse(map(int, lines)):
+                    line.render_digest()
+        return rv
+
+    @classmethod
+    def delete(cls, lines):
+        Project = Pool().get('project.work')
+
+        work_ids = [l.project.id for l in lines if l.project]
+        rv = super(ProjectHistory, cls).delete(lines)
+        Project.update_counters(work_ids)
+        return rv
+
+    @classmethod
+    def create_history_lines(cls, projects, changed_values):
         """
-        Creates a history line from the changed values of a project.work
+        Creates the history lines of the changed values of the given
+        project.work records. The previous values are read in a single
+        query and the lines inserted in multi-row statements.
+
+        :param projects: List of active records of project.work
+        :param changed_values: The values written to the projects
         """
-        if changed_values:
-            data = {}
+        Project = Pool().get('project.work')
+        cursor = Transaction().cursor
 
-            # TODO: Also create a line when assigned user is cleared from task
-            for field in ('assigned_to', 'state', 'progress_state',
-                    'constraint_start_time', 'constraint_finish_time'):
-                if field not in changed_values or not changed_values[field]:
-                    continue
-                data['previous_%s' % field] = getattr(project, field)
-                data['new_%s' % field] = changed_values[field]
+        # TODO: Also create a line when assigned user is cleared from task
+        field_names = [
+            f for f in HISTORIZED_FIELDS if changed_values.get(f)
+        ]
+        if not projects or not field_names:
+            return
 
-            if data:
-                if has_request_context():
-                    data['updated_by'] = request.nereid_user.id
-                else:
-                    # TODO: try to find the nereid user from the employee
-                    # if an employee made the update
-                    pass
-                data['project'] = project.id
-                return cls.create(data)
+        updated_by = None
+        if has_request_context():
+            updated_by = request.nereid_user.id
+        # TODO: try to find the nereid user from the employee if an
+        # employee made the update
+
+        now = datetime.utcnow()
+        user = Transaction().user
+        rows = []
+        for previous in Project.read(map(int, projects), field_names):
+            row = [previous['id'], updated_by, now, user, now]
+            for field in field_names:
+                row.extend([previous[field], changed_values[field]])
+            rows.append(row)
+
+        columns = ['project', 'updated_by', 'date', 'create_uid',
+            'create_date']
+        for field in field_names:
+            columns.extend(['previous_%s' % field, 'new_%s' % field])
+        placeholders = '(' + ', '.join(('%s',) * len(columns)) + ')'
+        # Each row takes a parameter per column
+        step = max(cursor.IN_MAX // len(columns), 1)
+        for i in range(0, len(rows), step):
+            sub_rows = rows[i:i + step]
+            cursor.execute(
+                'INSERT INTO "' + cls._table + '" '
+                '(' + ', '.join('"%s"' % c for c in columns) + ') '
+                'VALUES ' + ','.join((placeholders,) * len(sub_rows)),
+                list(chain.from_iterable(sub_rows))
+            )
+        Project.update_counters([row[0] for row in rows])
 
     @login_required
     def update_comment(self, task_id):
@@ -2045,17 +3654,44 @@ class ProjectHistory(ModelSQL, ModelView):
             })
         return redirect(request.referrer)
 
+    def render_digest(self):
+        """
+        Renders the text and HTML of the update for digests and for the
+        mails of later updates, if not done yet. This is done in the
+        request, the digests are built by the cron from the rendered
+        updates.
+        """
+        Outbox = Pool().get('project.mail.outbox')
+
+        if self.digest_text is not None:
+            return
+        self.write([self], {
+            'digest_text': Outbox.render(
+                'project/emails/digest_item_text.jinja', history=self
+            ),
+            'digest_html': Outbox.render(
+                'project/emails/digest_item_html.jinja', history=self
+            ),
+        })
+
+    def get_previous_updates(self):
+        """
+        Returns the latest MAIL_HISTORY_LIMIT updates of the task before
+        this one, newest first, read from the (project, id) index.
+        """
+        return self.search([
+            ('project', '=', self.project.id),
+            ('id', '<', self.id),
+        ], order=[('id', 'DESC')], limit=MAIL_HISTORY_LIMIT)
+
     def send_mail(self):
         """
         Send mail to all participants whenever there is any update on
         project.
 
         """
-        # Get the previous updates than the latest one.
-        last_history = self.search([
-            ('id', '<', self.id),
-            ('project.id', '=', self.project.id)
-        ], order=[('create_date', 'DESC')])
+        Outbox = Pool().get('project.mail.outbox')
+        Notification = Pool().get('project.work.notification')
 
         # Prepare the content of email.
         subject = "[#%s %s] - %s" % (
@@ -2063,33 +3699,184 @@ class ProjectHistory(ModelSQL, ModelView):
             self.project.work.name,
         )
 
-        receivers = map(
-            lambda user: user.email,
-            filter(lambda s: s.email, self.project.participants)
-        )
-        if self.updated_by.email in receivers:
-            receivers.remove(self.updated_by.email)
+        participants = [
+            p for p in self.project.participants
+            if p.email and p.email != self.updated_by.email
+        ]
 
+        # Users in digest mode get the update in their next digest
+        Notification.queue(self, [
+            p for p in participants if p.notification_mode == 'digest'
+        ])
+
+        receivers = [
+            p.email for p in participants if p.notification_mode != 'digest'
+        ]
         if not receivers:
             return
 
-        message = render_email(
-            from_email=CONFIG['smtp_from'],
-            to=', '.join(receivers),
-            subject=subject,
-            text_template='project/emails/text_content.jinja',
-            html_template='project/emails/html_content.jinja',
-            history=self,
-            last_history=last_history
-        )
+        # The previous updates are quoted from their rendering, which is
+        # done only once
+        last_history = self.get_previous_updates()
+        for line in last_history:
+            line.render_digest()
+        last_history = self.browse(map(int, last_history))
 
-        #message.add_header('reply-to', request.nereid_user.email)
+        context = {
+            'history': self,
+            'last_history': last_history,
+        }
+        Outbox.queue_shared(
+            receivers, subject,
+            Outbox.render('project/emails/text_content.jinja', **context),
+            Outbox.render('project/emails/html_content.jinja', **context),
+        )
+
+
+class ProjectHistoryArchive(ModelSQL, ModelView):
+    "Archived Project Work History"
+    # Cold storage of the old history lines of tasks done, see
+    # archive_history. The lines keep their id and are read only.
+    __name__ = 'project.work.history.archive'
+
+    date = fields.DateTime('Change Date', readonly=True)
+    create_uid = fields.Many2One('res.user', 'Create User', readonly=True)
+    project = fields.Many2One(
+        'project.work', 'Project Work', readonly=True, select=True
+    )
+    updated_by = fields.Many2One('nereid.user', 'Updated By', readonly=True)
+
+    previous_state = fields.Selection([
+        ('opened', 'Opened'),
+        ('done', 'Done'),
+        ], 'Prev. State', readonly=True)
+    new_state = fields.Selection([
+        ('opened', 'Opened'),
+        ('done', 'Done'),
+        ], 'New State', readonly=True)
+    previous_progress_state = fields.Selection(
+        PROGRESS_STATES, 'Prev. Progress State', readonly=True
+    )
+    new_progress_state = fields.Selection(
+        PROGRESS_STATES, 'New Progress State', readonly=True
+    )
+    comment = fields.Text('Comment', readonly=True)
+    previous_name = fields.Char('Prev. Name', readonly=True)
+    new_name = fields.Char('New Name', readonly=True)
+    previous_assigned_to = fields.Many2One(
+        'nereid.user', 'Prev. Assignee', readonly=True
+    )
+    new_assigned_to = fields.Many2One(
+        'nereid.user', 'New Assignee', readonly=True
+    )
+    previous_constraint_start_time = fields.DateTime(
+        "Constraint Start Time", readonly=True
+    )
+    new_constraint_start_time = fields.DateTime(
+        "Next Constraint Start Time", readonly=True
+    )
+    previous_constraint_finish_time = fields.DateTime(
+        "Constraint Finish Time", readonly=True
+    )
+    new_constraint_finish_time = fields.DateTime(
+        "Constraint  Finish Time", readonly=True
+    )
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(ProjectHistoryArchive, cls).__register__(module_name)
+
+        table = TableHandler(Transaction().cursor, cls, module_name)
+        table.index_action(['project', 'create_date'], 'add')
+
+    @classmethod
+    def get_archived_columns(cls):
+        """
+        Returns the columns copied from the history table to the archive
+        """
+        return [
+            name for name, field in cls._fields.iteritems()
+            if not isinstance(field, fields.Function)
+            and field._type not in ('one2many', 'many2many')
+        ]
+
+    @classmethod
+    def get_archivable_lines(cls, limit):
+        """
+        Returns the ids of the history lines to archive: the lines older
+        than HISTORY_ARCHIVE_AGE of the tasks done and left unchanged since
+        then. Lines still waiting for a digest are left in the history.
+
+        :param limit: Maximum number of lines returned
+        """
+        pool = Pool()
+        Project = pool.get('project.work')
+        History = pool.get('project.work.history')
+        Notification = pool.get('project.work.notification')
+        cursor = Transaction().cursor
+
+        limit_date = datetime.utcnow() - HISTORY_ARCHIVE_AGE
+        cursor.execute(
+            'SELECT h."id" FROM "' + History._table + '" h '
+            'JOIN "' + Project._table + '" w ON w."id" = h."project" '
+            'WHERE h."create_date" < %s AND w."state" = %s '
+            'AND COALESCE(w."write_date", w."create_date") < %s '
+            'AND NOT EXISTS (SELECT 1 '
+                'FROM "' + Notification._table + '" n '
+                'WHERE n."history" = h."id") '
+            'ORDER BY h."id" LIMIT %s',
+            (limit_date, 'done', limit_date, limit)
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+    @classmethod
+    def archive_lines(cls, line_ids):
+        """
+        Moves the given history lines to the archive, keeping their ids
+
+        :param line_ids: List of ids of project.work.history
+        """
+        pool = Pool()
+        Project = pool.get('project.work')
+        History = pool.get('project.work.history')
+        cursor = Transaction().cursor
+
+        columns = ', '.join('"%s"' % c for c in cls.get_archived_columns())
+        work_ids = []
+        for i in range(0, len(line_ids), cursor.IN_MAX):
+            sub_ids = line_ids[i:i + cursor.IN_MAX]
+            in_ids = '(' + ','.join(('%s',) * len(sub_ids)) + ')'
+            cursor.execute(
+                'SELECT DISTINCT "project" FROM "' + History._table + '" '
+                'WHERE "id" IN ' + in_ids, sub_ids
+            )
+            work_ids.extend(row[0] for row in cursor.fetchall())
+            cursor.execute(
+                'INSERT INTO "' + cls._table + '" (' + columns + ') '
+                'SELECT ' + columns + ' FROM "' + History._table + '" '
+                'WHERE "id" IN ' + in_ids, sub_ids
+            )
+            cursor.execute(
+                'DELETE FROM "' + History._table + '" '
+                'WHERE "id" IN ' + in_ids, sub_ids
+            )
+        Project.update_counters(work_ids)
+
+    @classmethod
+    def archive_history(cls):
+        """
+        Moves the old history lines of the tasks done to the archive. This
+        is called by the cron and commits after every HISTORY_ARCHIVE_BATCH
+        lines.
+        """
+        cursor = Transaction().cursor
 
-        # Send mail.
-        server = get_smtp_server()
-        server.sendmail(CONFIG['smtp_from'], receivers,
-            message.as_string())
-        server.quit()
+        while True:
+            line_ids = cls.get_archivable_lines(HISTORY_ARCHIVE_BATCH)
+            if not line_ids:
+                break
+            cls.archive_lines(line_ids)
+            cursor.commit()
 
 
 class ProjectWorkCommit(ModelSQL, ModelView):
@@ -2110,6 +3897,19 @@ class ProjectWorkCommit(ModelSQL, ModelView):
     commit_url = fields.Char('Commit URL', required=True)
     commit_id = fields.Char('Commit Id', required=True)
 
+    @classmethod
+    def __register__(cls, module_name):
+        Project = Pool().get('project.work')
+
+        super(ProjectWorkCommit, cls).__register__(module_name)
+
+        # Fill the counters of the works which do not have them yet. This
+        # needs the history and archive tables, registered before.
+        with Transaction().set_context(active_test=False):
+            Project.update_counters(map(int, Project.search([
+                ('comment_count', '=', None),
+            ])))
+
     def commit_github_hook_handler(self):
         """
         Handle post commit posts from GitHub
@@ -2203,6 +4003,1233 @@ class ProjectWorkCommit(ModelSQL, ModelView):
         return 'OK'
 
 
+class Attachment:
+    """
+    Keep the attachment counter of the works up to date and read and write
+    the files of the attachments in chunks
+    """
+    __name__ = 'ir.attachment'
+
+    #: Size of the file of the attachment, set when it is uploaded
+    file_size = fields.Integer('File Size', readonly=True)
+
+    #: Content of uploaded files, shared by the attachments of the same file
+    blob = fields.Many2One(
+        'project.work.blob', 'Blob', readonly=True, select=True,
+        ondelete='RESTRICT'
+    )
+
+    @classmethod
+    def get_work_ids(cls, resources):
+        """
+        Returns the ids of the works among the given resources
+
+        :param resources: list of resources as strings (model,id) or
+                          (model, id) pairs
+        """
+        Project = Pool().get('project.work')
+
+        work_ids = []
+        for resource in resources:
+            if isinstance(resource, (list, tuple)):
+                resource = '%s,%s' % tuple(resource)
+            if resource and resource.startswith(Project.__name__ + ','):
+                work_ids.append(int(resource.split(',')[1]))
+        return work_ids
+
+    @classmethod
+    def get_project_files_query(cls, project, file_type=None):
+        """
+        Returns the SQL query of the ids of the attachments of the project
+        and of its tasks, and the arguments of the query.
+
+        :param project: Active record of the project
+        :param file_type: 'data' or 'link' to return only those attachments
+        """
+        Project = Pool().get('project.work')
+
+        with Transaction().set_context(active_test=False):
+            work_query, work_args = Project.search([
+                'OR',
+                ('id', '=', project.id),
+                ('parent', '=', project.id),
+            ], order=[], query_string=True)
+        query = 'SELECT "id" FROM "' + cls._table + '" ' \
+            'WHERE "resource" IN (SELECT \'' + Project.__name__ + ',\' || ' \
+                'CAST("id" AS VARCHAR) FROM "' + Project._table + '" ' \
+                'WHERE "id" IN (' + work_query + '))'
+        args = list(work_args)
+        if file_type:
+            query += ' AND "type" = %s'
+            args.append(file_type)
+        return query, args
+
+    @classmethod
+    def search_project_files(cls, project, file_type, order, offset=0,
+            limit=None):
+        """
+        Returns the ids of the attachments of the project and of its tasks.
+
+        :param project: Active record of the project
+        :param file_type: 'data' or 'link' to return only those attachments
+        :param order: A key of FILES_ORDER
+        :param offset: The number of attachments skipped
+        :param limit: The maximum number of ids returned
+        """
+        cursor = Transaction().cursor
+
+        query, args = cls.get_project_files_query(project, file_type)
+        limit_clause = ''
+        if limit is not None:
+            limit_clause = ' LIMIT %s OFFSET %s'
+            args = args + [limit, offset]
+        cursor.execute(
+            'SELECT "id" FROM "' + cls._table + '" '
+            'WHERE "id" IN (' + query + ') '
+            'ORDER BY ' + FILES_ORDER[order] + limit_clause, args
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+    @classmethod
+    def count_project_files(cls, project, file_type):
+        """
+        Returns the number of attachments of the project and of its tasks.
+
+        :param project: Active record of the project
+        :param file_type: 'data' or 'link' to count only those attachments
+        """
+        cursor = Transaction().cursor
+
+        query, args = cls.get_project_files_query(project, file_type)
+        cursor.execute(
+            'SELECT COUNT(*) FROM (' + query + ') AS "files"', args
+        )
+        return cursor.fetchone()[0]
+
+    @classmethod
+    def get_resources(cls, attachments):
+        """
+        Returns the resources of the attachments as strings
+
+        :param attachments: list of active records of ir.attachment
+        """
+        return [
+            row['resource'] for row in cls.read(
+                map(int, attachments), ['resource']
+            )
+        ]
+
+    @classmethod
+    def get_store_path(cls, digest, collision=0):
+        """
+        Returns the path in the file store of the file with the given digest
+        and collision number, the same way trytond stores the attachments.
+        """
+        filename = digest
+        if collision:
+            filename = filename + '-' + str(collision)
+        return os.path.join(
+            CONFIG['data_path'], Transaction().cursor.dbname,
+            filename[0:2], filename[2:4], filename
+        )
+
+    def get_file_path(self):
+        """
+        Returns the path of the file of the attachment in the file store,
+        None if the attachment has no file there.
+        """
+        if self.type != 'data' or not self.digest:
+            return None
+        path = self.get_store_path(self.digest, self.collision)
+        if not os.path.isfile(path):
+            return None
+        return path
+
+    @classmethod
+    def move_to_store(cls, path, digest):
+        """
+        Moves the file at path into the file store and returns the digest
+        and collision number of an attachment of it. If the store already
+        has the same file, it is reused.
+
+        :param path: Path of a file on the file system of the store
+        :param digest: MD5 hex digest of the file
+        """
+        collision = 0
+        while True:
+            store_path = cls.get_store_path(digest, collision)
+            if not os.path.exists(store_path):
+                directory = os.path.dirname(store_path)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory, 0770)
+                os.rename(path, store_path)
+                break
+            if filecmp.cmp(path, store_path, shallow=False):
+                os.remove(path)
+                break
+            collision += 1
+        return {
+            'digest': digest,
+            'collision': collision,
+        }
+
+    @classmethod
+    def add_to_store(cls, path, md5_digest, sha256_digest, size):
+        """
+        Adds the file at path to the content addressed store and returns the
+        values (digest, collision, blob and file_size) of an attachment of
+        it. If the store already has a file with the same SHA-256 digest,
+        the file at path is removed and the attachment will share the
+        existing one.
+
+        :param path: Path of a file on the file system of the store
+        :param md5_digest: MD5 hex digest of the file
+        :param sha256_digest: SHA-256 hex digest of the file
+        :param size: Size of the file in bytes
+        """
+        Blob = Pool().get('project.work.blob')
+        cursor = Transaction().cursor
+
+        blobs = Blob.search([('sha256', '=', sha256_digest)], limit=1)
+        if blobs:
+            blob, = blobs
+            os.remove(path)
+        else:
+            values = cls.move_to_store(path, md5_digest)
+            values.update({
+                'sha256': sha256_digest,
+                'size': size,
+            })
+            cursor.execute('SAVEPOINT add_to_store')
+            try:
+                blob = Blob.create(values)
+            except Exception:
+                exc_info = sys.exc_info()
+                cursor.execute('ROLLBACK TO SAVEPOINT add_to_store')
+                # An identical upload may have added the blob meanwhile. The
+                # file in the store is then the same and the attachment uses
+                # it without the blob, which the garbage collection checks.
+                with Transaction().new_cursor():
+                    added = Blob.search([
+                        ('sha256', '=', sha256_digest),
+                    ], count=True)
+                if not added:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                return {
+                    'digest': values['digest'],
+                    'collision': values['collision'],
+                    'blob': None,
+                    'file_size': size,
+                }
+            cursor.execute('RELEASE SAVEPOINT add_to_store')
+        return {
+            'digest': blob.digest,
+            'collision': blob.collision,
+            'blob': blob.id,
+            'file_size': blob.size,
+        }
+
+    @classmethod
+    def hash_file(cls, path):
+        """
+        Returns the MD5 and SHA-256 hex digests of the file at path, read in
+        chunks of FILE_CHUNK_SIZE
+        """
+        md5_digest = hashlib.md5()
+        sha256_digest = hashlib.sha256()
+        with open(path, 'rb') as file_:
+            for chunk in iter(lambda: file_.read(FILE_CHUNK_SIZE), ''):
+                md5_digest.update(chunk)
+                sha256_digest.update(chunk)
+        return md5_digest.hexdigest(), sha256_digest.hexdigest()
+
+    @classmethod
+    def store_file(cls, file_, max_size=None):
+        """
+        Copies a file object into the file store in chunks of
+        FILE_CHUNK_SIZE and returns the values (digest, collision, blob and
+        file_size) of an attachment of it (see :meth:`add_to_store`).
+
+        None is returned and nothing is stored if the file is larger than
+        max_size.
+
+        :param file_: File object to read
+        :param max_size: Maximum size in bytes of the file, None for no
+                         limit
+        """
+        directory = os.path.join(
+            CONFIG['data_path'], Transaction().cursor.dbname
+        )
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0770)
+
+        md5_digest = hashlib.md5()
+        sha256_digest = hashlib.sha256()
+        size = 0
+        # The temporary file is on the file system of the store, so it can
+        # be moved there
+        fd, path = tempfile.mkstemp(dir=directory, suffix='.upload')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                while True:
+                    chunk = file_.read(FILE_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if max_size is not None and size > max_size:
+                        return None
+                    md5_digest.update(chunk)
+                    sha256_digest.update(chunk)
+                    tmp_file.write(chunk)
+            return cls.add_to_store(
+                path, md5_digest.hexdigest(), sha256_digest.hexdigest(), size
+            )
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    @classmethod
+    def create_stored(cls, values):
+        """
+        Creates the attachment of a file added to the store by
+        :meth:`store_file` or :meth:`add_to_store`. If the creation fails,
+        the file is removed from the store unless a committed blob or
+        attachment uses it.
+
+        :param values: The values of the attachment
+        """
+        Blob = Pool().get('project.work.blob')
+
+        try:
+            return cls.create(values)
+        except Exception:
+            exc_info = sys.exc_info()
+            domain = [
+                ('digest', '=', values['digest']),
+                ('collision', '=', values.get('collision') or 0),
+            ]
+            with Transaction().new_cursor():
+                used = Blob.search(domain, count=True) or \
+                    cls.search(domain, count=True)
+            if not used:
+                path = cls.get_store_path(
+                    values['digest'], values.get('collision') or 0
+                )
+                if os.path.exists(path):
+                    os.remove(path)
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def get_etag(self):
+        """
+        Returns a strong entity tag of the content of the attachment
+        """
+        if self.blob:
+            return self.blob.sha256
+        if self.digest:
+            return '%s-%s' % (self.digest, self.collision or 0)
+        return hashlib.md5(str(self.data or '')).hexdigest()
+
+    def stream_response(self, as_attachment=True):
+        """
+        Returns a response which sends the content of the attachment in
+        chunks of FILE_CHUNK_SIZE straight from the file store.
+
+        Conditional requests (If-None-Match) and single byte range requests
+        (Range, If-Range) are supported.
+
+        :param as_attachment: Ask the browser to save the file instead of
+                              displaying it
+        """
+        path = self.get_file_path()
+        if path is not None:
+            size = os.path.getsize(path)
+            open_file = lambda: open(path, 'rb')
+        else:
+            # Attachments stored outside of the file store
+            data = str(self.data or '')
+            size = len(data)
+            open_file = lambda: StringIO(data)
+
+        etag = self.get_etag()
+        headers = {'Accept-Ranges': 'bytes'}
+        if as_attachment:
+            headers['Content-Disposition'] = 'attachment; filename="%s"' % (
+                self.name.encode('utf-8').replace('"', '')
+            )
+        mimetype = guess_type(self.name)[0] or 'application/octet-stream'
+
+        if etag in request.if_none_match:
+            response = Response(status=304, headers=headers)
+            response.set_etag(etag)
+            return response
+
+        start, stop, status = 0, size, 200
+        byte_range = request.range
+        if_range = request.headers.get('If-Range')
+        if byte_range and byte_range.units == 'bytes' and \
+                len(byte_range.ranges) == 1 and \
+                (not if_range or if_range.strip('"') == etag):
+            content_range = byte_range.range_for_length(size)
+            if content_range is None:
+                headers['Content-Range'] = 'bytes */%d' % size
+                return Response(status=416, headers=headers)
+            start, stop = content_range
+            status = 206
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                start, stop - 1, size
+            )
+        headers['Content-Length'] = str(stop - start)
+
+        def generate():
+            file_ = open_file()
+            try:
+                file_.seek(start)
+                remaining = stop - start
+                while remaining > 0:
+                    chunk = file_.read(min(FILE_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+            finally:
+                file_.close()
+
+        response = Response(
+            generate(), status=status, headers=headers, mimetype=mimetype,
+            direct_passthrough=True
+        )
+        response.set_etag(etag)
+        return response
+
+    @classmethod
+    def create(cls, values):
+        Project = Pool().get('project.work')
+        Blob = Pool().get('project.work.blob')
+
+        attachment = super(Attachment, cls).create(values)
+        Project.update_counters(cls.get_work_ids([values.get('resource')]))
+        if values.get('blob'):
+            Blob.update_ref_counts([values['blob']])
+        if cls.get_work_ids([values.get('resource')]):
+            attachment.queue_thumbnails()
+        return attachment
+
+    def is_image(self):
+        """
+        Returns True if the attachment is an image file
+        """
+        mimetype = guess_type(self.name or '')[0]
+        return self.type == 'data' and bool(mimetype) and \
+            mimetype.startswith('image/')
+
+    def queue_thumbnails(self):
+        """
+        Queues the generation of the thumbnail and preview of the
+        attachment, if it is an image and PIL is available.
+        """
+        Thumbnail = Pool().get('project.work.thumbnail')
+
+        if Image is None or not self.is_image():
+            return
+        Thumbnail.create({'attachment': self.id})
+
+    @classmethod
+    def write(cls, attachments, values):
+        Project = Pool().get('project.work')
+        Blob = Pool().get('project.work.blob')
+
+        if 'data' in values and 'blob' not in values:
+            # The new content goes to the store like an upload, so that the
+            # attachments refer to the blob of their new content
+            values = values.copy()
+            if values['data']:
+                values.update(
+                    cls.store_file(StringIO(str(values.pop('data'))))
+                )
+            else:
+                values.update({'blob': None, 'file_size': None})
+
+        if 'resource' not in values and 'blob' not in values:
+            return super(Attachment, cls).write(attachments, values)
+
+        resources = cls.get_resources(attachments)
+        blob_ids = [a.blob.id for a in attachments if a.blob]
+        rv = super(Attachment, cls).write(attachments, values)
+        if 'resource' in values:
+            Project.update_counters(
+                cls.get_work_ids(resources + [values['resource']])
+            )
+        if 'blob' in values:
+            Blob.update_ref_counts(blob_ids + [values['blob']])
+        return rv
+
+    @classmethod
+    def delete(cls, attachments):
+        Project = Pool().get('project.work')
+        Blob = Pool().get('project.work.blob')
+
+        resources = cls.get_resources(attachments)
+        blob_ids = [a.blob.id for a in attachments if a.blob]
+        rv = super(Attachment, cls).delete(attachments)
+        Project.update_counters(cls.get_work_ids(resources))
+        Blob.update_ref_counts(blob_ids)
+        return rv
+
+
+class AttachmentBlob(ModelSQL):
+    "Attachment Blob"
+    # A file of the store addressed by its SHA-256 digest. Attachments of
+    # the same content share the blob, which is removed with its file once
+    # no attachment refers to it.
+    __name__ = 'project.work.blob'
+    _rec_name = 'sha256'
+
+    sha256 = fields.Char('SHA-256', size=64, required=True, select=True)
+    digest = fields.Char('Digest', size=32, required=True)
+    collision = fields.Integer('Collision')
+    size = fields.Integer('Size', required=True)
+    ref_count = fields.Integer('References', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(AttachmentBlob, cls).__setup__()
+        cls._sql_constraints += [
+            (
+                'sha256_unique',
+                'UNIQUE(sha256)',
+                'The content of a blob must be unique',
+            ),
+        ]
+
+    @staticmethod
+    def default_collision():
+        return 0
+
+    @staticmethod
+    def default_ref_count():
+        return 0
+
+    @classmethod
+    def update_ref_counts(cls, blob_ids):
+        """
+        Recompute the number of attachments referring to the given blobs
+
+        :param blob_ids: list of ids of project.work.blob
+        """
+        Attachment = Pool().get('ir.attachment')
+        cursor = Transaction().cursor
+
+        blob_ids = list(set(filter(None, blob_ids)))
+        table = '"' + cls._table + '"'
+        for i in range(0, len(blob_ids), cursor.IN_MAX):
+            sub_ids = blob_ids[i:i + cursor.IN_MAX]
+            cursor.execute(
+                'UPDATE ' + table + ' SET '
+                '"ref_count" = (SELECT COUNT(*) '
+                    'FROM "' + Attachment._table + '" '
+                    'WHERE "blob" = ' + table + '."id"), '
+                '"write_date" = %s '
+                'WHERE "id" IN (' + ','.join(('%s',) * len(sub_ids)) + ')',
+                [datetime.now()] + sub_ids
+            )
+
+    @classmethod
+    def delete_unused(cls):
+        """
+        Deletes the blobs no attachment has referred to for
+        BLOB_GRACE_PERIOD and returns the paths of their files, which can
+        be removed once the deletion is committed. The files which an
+        attachment created outside of the blob store uses are kept.
+        """
+        Attachment = Pool().get('ir.attachment')
+
+        blobs = cls.search([
+            ('ref_count', '=', 0),
+            ('write_date', '<', datetime.now() - BLOB_GRACE_PERIOD),
+        ])
+        # Recount, uploads may have used the blobs in the meantime
+        cls.update_ref_counts(map(int, blobs))
+        blobs = cls.search([
+            ('id', 'in', map(int, blobs)),
+            ('ref_count', '=', 0),
+        ])
+        paths = [
+            Attachment.get_store_path(blob.digest, blob.collision)
+            for blob in blobs
+            if not Attachment.search([
+                ('digest', '=', blob.digest),
+                ('collision', '=', blob.collision),
+            ], limit=1)
+        ]
+        cls.delete(blobs)
+        return paths
+
+    @staticmethod
+    def remove_files(paths):
+        """
+        Removes the files of the store at the given paths
+        """
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    @classmethod
+    def collect_garbage(cls):
+        """
+        Removes the blobs no attachment refers to anymore with their files.
+        This is called by the cron. The files are removed only once the
+        deletion of the blobs is committed, so that no blob or attachment
+        is left without its file.
+        """
+        cursor = Transaction().cursor
+
+        paths = cls.delete_unused()
+        cursor.commit()
+        cls.remove_files(paths)
+
+
+class AttachmentThumbnail(ModelSQL):
+    "Attachment Thumbnail"
+    # The images of every size in THUMBNAIL_SIZES of an image attachment,
+    # stored next to the file store under the key of the content so that
+    # the attachments of the same file share them
+    __name__ = 'project.work.thumbnail'
+
+    attachment = fields.Many2One(
+        'ir.attachment', 'Attachment', required=True, select=True,
+        ondelete='CASCADE'
+    )
+    key = fields.Char('Key', readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], 'State', required=True, readonly=True, select=True)
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    def get_path(self, size):
+        """
+        Returns the path of the image of the given size
+
+        :param size: One of the keys of THUMBNAIL_SIZES
+        """
+        return os.path.join(
+            CONFIG['data_path'], Transaction().cursor.dbname, 'thumbnails',
+            self.key[0:2], '%s-%s.jpg' % (self.key, size)
+        )
+
+    def generate(self):
+        """
+        Generates the images of all the sizes from the attachment
+        """
+        attachment = self.attachment
+        path = attachment.get_file_path()
+        if path is not None:
+            image_file = open(path, 'rb')
+        else:
+            image_file = StringIO(str(attachment.data or ''))
+
+        # The key is derived from the content, the images of an already
+        # processed file are reused
+        self.key = hashlib.sha1(attachment.get_etag()).hexdigest()
+        try:
+            for size, box in THUMBNAIL_SIZES.iteritems():
+                target = self.get_path(size)
+                if os.path.isfile(target):
+                    continue
+                directory = os.path.dirname(target)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory, 0770)
+
+                image_file.seek(0)
+                image = Image.open(image_file)
+                # Let the decoder downscale large JPEG files while reading
+                image.draft('RGB', box)
+                image = image.convert('RGB')
+                image.thumbnail(box, Image.ANTIALIAS)
+
+                fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.jpg')
+                with os.fdopen(fd, 'wb') as tmp_file:
+                    image.save(tmp_file, 'JPEG', quality=85)
+                os.rename(tmp_path, target)
+        finally:
+            image_file.close()
+        self.write([self], {'key': self.key, 'state': 'done'})
+
+    @classmethod
+    def generate_pending(cls):
+        """
+        Generates the pending thumbnails. This is called by the cron and
+        commits after every THUMBNAIL_BATCH attachments.
+        """
+        cursor = Transaction().cursor
+
+        if Image is None:
+            return
+        while True:
+            thumbnails = cls.search(
+                [('state', '=', 'pending')], limit=THUMBNAIL_BATCH
+            )
+            if not thumbnails:
+                break
+            for thumbnail in thumbnails:
+                try:
+                    thumbnail.generate()
+                except Exception:
+                    logger.warning(
+                        'Could not generate the thumbnails of attachment %d',
+                        thumbnail.attachment.id, exc_info=True
+                    )
+                    cls.write([thumbnail], {'state': 'failed'})
+            cursor.commit()
+
+
+class MailOutbox(ModelSQL, ModelView):
+    "Mail Outbox"
+    __name__ = 'project.mail.outbox'
+    _rec_name = 'subject'
+
+    from_addr = fields.Char('From', required=True, readonly=True)
+    to_addrs = fields.Text('To', required=True, readonly=True)
+    subject = fields.Char('Subject', readonly=True)
+    message = fields.Text('Message', required=True, readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    ], 'State', required=True, readonly=True, select=True)
+    attempts = fields.Integer('Attempts', readonly=True)
+    next_attempt = fields.DateTime('Next Attempt', readonly=True, select=True)
+    last_error = fields.Text('Last Error', readonly=True)
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @classmethod
+    def queue(cls, receivers, message, from_addr=None):
+        """
+        Queues a message for the outbox worker instead of sending it
+        during the request.
+
+        :param receivers: List of email addresses
+        :param message: The email message, as returned by render_email
+        :param from_addr: The sender, the smtp_from of the configuration
+                          by default
+        """
+        return cls.create({
+            'from_addr': from_addr or CONFIG['smtp_from'],
+            'to_addrs': '\n'.join(receivers),
+            'subject': cls.get_subject(message),
+            'message': message.as_string(),
+            'next_attempt': datetime.now(),
+        })
+
+    @staticmethod
+    def get_subject(message):
+        """
+        Returns the subject of the message as unicode. The subject is set
+        as unicode, as a str or as an encoded Header depending on how the
+        message was built.
+        """
+        subject = message['Subject'] or u''
+        if isinstance(subject, unicode):
+            return subject
+        return unicode(make_header(decode_header(str(subject))))
+
+    @staticmethod
+    def render(template, **context):
+        """
+        Renders a template of a mail body. The template is compiled once per
+        process by the jinja environment of the application, and the time
+        taken is recorded in RENDER_TIMINGS.
+        """
+        start = time.time()
+        rv = unicode(render_template(template, **context))
+        elapsed = time.time() - start
+
+        timing = RENDER_TIMINGS[template]
+        timing[0] += 1
+        timing[1] += elapsed
+        logger.debug('Rendered %s in %.4fs', template, elapsed)
+        return rv
+
+    @staticmethod
+    def get_render_timings():
+        """
+        Returns the number of renderings, the total and the average seconds
+        spent by each mail template rendered in this process.
+        """
+        return dict(
+            (template, {
+                'count': count,
+                'total': total,
+                'average': total / count,
+            }) for template, (count, total) in RENDER_TIMINGS.iteritems()
+        )
+
+    @staticmethod
+    def build_message(subject, to, text, html, from_addr=None):
+        """
+        Returns the mail with the text and HTML bodies, which are rendered
+        once and shared by all the receivers.
+
+        :param to: The email addresses of the receivers, comma separated
+        """
+        message = MIMEMultipart('alternative')
+        message['Subject'] = Header(subject, 'utf-8')
+        message['From'] = from_addr or CONFIG['smtp_from']
+        message['To'] = to
+        message.attach(MIMEText(text.encode('utf-8'), 'plain', 'utf-8'))
+        message.attach(MIMEText(html.encode('utf-8'), 'html', 'utf-8'))
+        return message
+
+    @classmethod
+    def queue_shared(cls, receivers, subject, text, html):
+        """
+        Queues a single mail with the same bodies to all the receivers,
+        which is stored once and sent in a single SMTP transaction.
+
+        :param receivers: List of email addresses
+        """
+        return cls.queue(receivers, cls.build_message(
+            subject, ', '.join(receivers), text, html
+        ))
+
+    @classmethod
+    def send_pending(cls):
+        """
+        Sends the pending mails which are due over a single SMTP connection.
+        This is called by the cron and commits after every MAIL_BATCH mails.
+
+        A mail which could not be sent is retried after MAIL_RETRY_DELAY,
+        doubled at every attempt, and given up after MAIL_MAX_ATTEMPTS.
+        """
+        cursor = Transaction().cursor
+
+        server = None
+        try:
+            while True:
+                mails = cls.search([
+                    ('state', '=', 'pending'),
+                    ('next_attempt', '<=', datetime.now()),
+                ], order=[('next_attempt', 'ASC'), ('id', 'ASC')],
+                    limit=MAIL_BATCH)
+                if not mails:
+                    break
+                for mail in mails:
+                    try:
+                        if server is None:
+                            server = get_smtp_server()
+                        refused = server.sendmail(
+                            mail.from_addr, mail.to_addrs.split('\n'),
+                            mail.message
+                        )
+                    except smtplib.SMTPServerDisconnected, exc:
+                        # Reconnect for the next mail
+                        server = None
+                        mail.retry(exc)
+                    except (smtplib.SMTPException, IOError), exc:
+                        mail.retry(exc)
+                    else:
+                        # The mail was accepted for the other recipients
+                        cls.write([mail], {
+                            'state': 'sent',
+                            'attempts': mail.attempts + 1,
+                            'last_error': mail.get_refused_error(refused),
+                        })
+                cursor.commit()
+        finally:
+            if server is not None:
+                try:
+                    server.quit()
+                except smtplib.SMTPException:
+                    pass
+
+    def get_refused_error(self, refused):
+        """
+        Returns the error to record for the recipients refused by the SMTP
+        server, or None if all of them were accepted.
+
+        :param refused: Dictionary of the refused recipients returned by
+                        sendmail, with the SMTP code and message of each
+        """
+        if not refused:
+            return None
+        logger.warning(
+            'Mail %d refused for: %s', self.id, ', '.join(sorted(refused))
+        )
+        return u'Refused recipients:\n%s' % u'\n'.join(
+            u'%s: %s %s' % (addr, code, unicode(message, 'utf-8', 'replace'))
+            for addr, (code, message) in sorted(refused.items())
+        )
+
+    def retry(self, error):
+        """
+        Schedules the next attempt to send the mail after a failure, or
+        gives the mail up after MAIL_MAX_ATTEMPTS.
+
+        :param error: The exception raised while sending
+        """
+        attempts = self.attempts + 1
+        logger.warning(
+            'Could not send mail %d (attempt %d): %s', self.id, attempts,
+            error
+        )
+        values = {
+            'attempts': attempts,
+            'last_error': unicode(error),
+        }
+        if attempts >= MAIL_MAX_ATTEMPTS:
+            values['state'] = 'failed'
+        else:
+            delay = MAIL_RETRY_DELAY
+            for _ in range(attempts - 1):
+                delay = delay + delay
+            values['next_attempt'] = datetime.now() + delay
+        self.write([self], values)
+
+
+class ProjectNotification(ModelSQL):
+    "Pending Notification"
+    # An update of a task waiting for the next digest of a user
+    __name__ = 'project.work.notification'
+
+    history = fields.Many2One(
+        'project.work.history', 'History', required=True, select=True,
+        ondelete='CASCADE'
+    )
+    user = fields.Many2One(
+        'nereid.user', 'User', required=True, select=True, ondelete='CASCADE'
+    )
+
+    @classmethod
+    def queue(cls, history, users):
+        """
+        Adds the update to the next digest of the users
+
+        :param history: Active record of project.work.history
+        :param users: List of active records of nereid.user
+        """
+        if not users:
+            return
+        history.render_digest()
+        for user in users:
+            cls.create({
+                'history': history.id,
+                'user': user.id,
+            })
+
+    @classmethod
+    def send_digests(cls):
+        """
+        Queues a digest of the pending updates for every user whose digest
+        interval has elapsed. This is called by the cron and commits after
+        every user.
+        """
+        NereidUser = Pool().get('nereid.user')
+        Outbox = Pool().get('project.mail.outbox')
+        cursor = Transaction().cursor
+
+        cursor.execute('SELECT DISTINCT "user" FROM "' + cls._table + '"')
+        user_ids = [row[0] for row in cursor.fetchall()]
+
+        for user in NereidUser.browse(user_ids):
+            now = datetime.now()
+            if user.last_digest and user.last_digest + relativedelta(
+                    minutes=user.digest_interval or 0) > now:
+                continue
+
+            notifications = cls.search([
+                ('user', '=', user.id),
+            ], order=[('id', 'ASC')])
+            if user.email:
+                Outbox.queue(
+                    [user.email], cls.build_digest(user, notifications)
+                )
+            cls.delete(notifications)
+            NereidUser.write([user], {'last_digest': now})
+            cursor.commit()
+
+    @classmethod
+    def build_digest(cls, user, notifications):
+        """
+        Returns the digest mail of the notifications, built from the
+        updates rendered when they were made and grouped by task.
+
+        :param user: Active record of nereid.user receiving the digest
+        :param notifications: List of active records of
+                              project.work.notification
+        """
+        Outbox = Pool().get('project.mail.outbox')
+
+        tasks = []
+        updates = defaultdict(list)
+        for notification in notifications:
+            history = notification.history
+            if history.project not in updates:
+                tasks.append(history.project)
+            updates[history.project].append(history)
+
+        text_parts, html_parts = [], []
+        for task in tasks:
+            title = u'#%d %s' % (task.id, task.name)
+            # Updates edited outside of a request have not been rendered
+            # again, their comment is used instead
+            text_parts.append(u'%s\n%s\n\n%s' % (
+                title, '=' * len(title), u'\n\n'.join(
+                    h.digest_text or h.comment or u''
+                    for h in updates[task]
+                )
+            ))
+            html_parts.append(u'<h3>%s</h3>\n%s' % (
+                escape(title), u'\n'.join(
+                    h.digest_html or u'<p>%s</p>' % escape(h.comment or u'')
+                    for h in updates[task]
+                )
+            ))
+
+        return Outbox.build_message(
+            '[Project Updates] %d update(s) on %d task(s)' % (
+                len(notifications), len(tasks)
+            ),
+            user.email,
+            u'\n\n\n'.join(text_parts),
+            u'<html><body>%s</body></html>' % u'\n<hr/>\n'.join(
+                html_parts
+            ),
+        )
+
+
+class ProjectUpload(ModelSQL):
+    "Resumable Upload"
+    # The content received so far is kept in a file next to the file store
+    # until the upload is complete
+    __name__ = 'project.work.upload'
+
+    work = fields.Many2One(
+        'project.work', 'Work', required=True, select=True,
+        ondelete='CASCADE'
+    )
+    nereid_user = fields.Many2One(
+        'nereid.user', 'User', required=True, select=True
+    )
+    name = fields.Char('Name', required=True)
+    description = fields.Text('Description')
+    size = fields.Integer('Size', required=True)
+    received = fields.Integer('Received', required=True)
+
+    @staticmethod
+    def default_received():
+        return 0
+
+    def get_part_path(self):
+        """
+        Returns the path of the file with the content received so far
+        """
+        return os.path.join(
+            CONFIG['data_path'], Transaction().cursor.dbname, 'uploads',
+            '%d.part' % self.id
+        )
+
+    @classmethod
+    def delete(cls, uploads):
+        paths = [u.get_part_path() for u in uploads]
+        super(ProjectUpload, cls).delete(uploads)
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    @classmethod
+    def clean_stale(cls):
+        """
+        Removes the uploads which did not receive anything for
+        RESUMABLE_UPLOAD_EXPIRY. This is called by the cron.
+        """
+        expiry = datetime.now() - RESUMABLE_UPLOAD_EXPIRY
+        cls.delete(cls.search([
+            'OR', [
+                ('write_date', '<', expiry),
+            ], [
+                ('write_date', '=', None),
+                ('create_date', '<', expiry),
+            ],
+        ]))
+
+    @login_required
+    def upload_chunk(self):
+        """
+        GET returns the offset from which the upload has to be resumed.
+        POST appends the chunk of the file field at the offset field, which
+        must be the size received so far. The attachment is created when
+        the whole file is received.
+        """
+        if self.nereid_user != request.nereid_user:
+            abort(404)
+
+        if request.method == 'POST':
+            offset = request.form.get('offset', type=int)
+            if offset != self.received:
+                # The client has to resume from the received size
+                response = jsonify({
+                    'success': False,
+                    'offset': self.received,
+                })
+                response.status_code = 409
+                return response
+
+            path = self.get_part_path()
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0770)
+
+            received = self.received
+            stream = request.files['file'].stream
+            with open(path, received and 'r+b' or 'wb') as part_file:
+                part_file.seek(received)
+                part_file.truncate()
+                while True:
+                    chunk = stream.read(FILE_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    received += len(chunk)
+                    if received > self.size:
+                        part_file.truncate(self.received)
+                        abort(413)
+                    part_file.write(chunk)
+            self.write([self], {'received': received})
+
+            if received == self.size:
+                attachment = self.finish()
+                return jsonify({
+                    'success': True,
+                    'offset': received,
+                    'attachment': attachment.id,
+                })
+
+        return jsonify({
+            'success': True,
+            'offset': self.received,
+            'size': self.size,
+        })
+
+    def finish(self):
+        """
+        Moves the received file to the file store, creates its attachment
+        and removes the upload.
+        """
+        Attachment = Pool().get('ir.attachment')
+
+        # Uploads to the project may have been completed in the meantime.
+        # The upload is left to the cron, deleting it here would remove its
+        # file while the abort rolls the deletion back.
+        limit = self.work.get_upload_limit()
+        if limit is not None and self.size > limit:
+            abort(413)
+
+        path = self.get_part_path()
+        md5_digest, sha256_digest = Attachment.hash_file(path)
+        values = Attachment.add_to_store(
+            path, md5_digest, sha256_digest, self.size
+        )
+        values.update({
+            'name': self.name,
+            'type': 'data',
+            'resource': '%s,%d' % (self.work.__name__, self.work.id),
+            'description': self.description or '',
+        })
+        attachment = Attachment.create_stored(values)
+        self.delete([self])
+        return attachment
+
+
+class ProjectParticipantRemoval(ModelSQL, ModelView):
+    "Participant Removal"
+    __name__ = 'project.work.participant.removal'
+
+    project = fields.Many2One(
+        'project.work', 'Project', required=True, select=True,
+        ondelete='CASCADE', readonly=True
+    )
+    participant = fields.Many2One(
+        'nereid.user', 'Participant', required=True, readonly=True
+    )
+    removed_by = fields.Many2One('nereid.user', 'Removed By', readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+    ], 'State', required=True, readonly=True, select=True)
+    total = fields.Integer('Total Tasks', readonly=True)
+    processed = fields.Integer('Processed Tasks', readonly=True)
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_processed():
+        return 0
+
+    @classmethod
+    def process_pending(cls):
+        """
+        Process the pending removals. This is called by the cron and commits
+        after every batch of tasks, so that the progress can be followed.
+        """
+        Project = Pool().get('project.work')
+        cursor = Transaction().cursor
+
+        for removal in cls.search([('state', '=', 'pending')]):
+            project = removal.project
+            participant_id = removal.participant.id
+            processed = removal.processed
+            while True:
+                with Transaction().set_context(active_test=False):
+                    task_ids = map(int, Project.search(
+                        project.get_participant_tasks_domain(participant_id),
+                        limit=PARTICIPANT_REMOVAL_BATCH
+                    ))
+                if not task_ids:
+                    break
+                Project.remove_participant_from_works(task_ids, participant_id)
+                processed = min(processed + len(task_ids), removal.total)
+                cls.write([removal], {'processed': processed})
+                cursor.commit()
+
+            project.create_participant_removal_history(
+                participant_id, removal.removed_by and removal.removed_by.id,
+                removal.total
+            )
+            cls.write([removal], {
+                'state': 'done',
+                'processed': removal.total,
+            })
+            cursor.commit()
+
+    @login_required
+    def render_progress(self):
+        """
+        Returns the progress of the removal as JSON
+        """
+        Project = Pool().get('project.work')
+
+        # Only those who can see the project can see the progress
+        Project.get_project(self.project.id)
+
+        return jsonify({
+            'state': self.state,
+            'total': self.total,
+            'processed': self.processed,
+        })
+
+
 @registration.connect
 def invitation_new_user_handler(nereid_user_id):
     """When the invite is sent to a new user, he is sent an invitation key
@@ -2217,6 +5244,7 @@ def invitation_new_user_handler(nereid_user_id):
         Invitation = Pool().get('project.work.invitation')
         Project = Pool().get('project.work')
         NereidUser = Pool().get('nereid.user')
+        Outbox = Pool().get('project.mail.outbox')
 
     except KeyError:
         # Just return silently. This KeyError is cause if the module is not
@@ -2257,9 +5285,7 @@ def invitation_new_user_handler(nereid_user_id):
         subject=subject, to=', '.join(receivers),
         from_email=CONFIG['smtp_from'], invitation=invitation
     )
-    server = get_smtp_server()
-    server.sendmail(CONFIG['smtp_from'], receivers, email_message.as_string())
-    server.quit()
+    Outbox.queue(receivers, email_message)
 
     Project.write(
         [invitation.project], {
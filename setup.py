@@ -68,6 +68,9 @@ setup(name='trytond_nereid_project',
     ],
     license='GPL-3',
     install_requires=requires,
+    extras_require={
+        'thumbnails': ['PIL'],
+    },
     tests_require=['minimock'],
     zip_safe=False,
     entry_points="""
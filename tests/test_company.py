@@ -118,6 +118,46 @@ class TestCompany(NereidTestCase):
                     registered_user1
                 )
 
+    def test_0020_project_admin_ids_cache(self):
+        """
+        The cached admin ids must follow changes to the project admins
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            currency = self.Currency.create({
+                'name': 'US Dollar',
+                'code': 'USD',
+                'symbol': '$',
+            })
+            company = self.Company.create({
+                'name': 'Openlabs',
+                'currency': currency.id,
+            })
+            party = self.Party.create({
+                'name': 'Registered User1',
+            })
+            registered_user = self.NereidUser.create({
+                'party': party.id,
+                'display_name': 'Registered User',
+                'email': 'email@example.com',
+                'password': 'password',
+                'company': company.id,
+            })
+
+            self.assertEqual(company.get_project_admin_ids(), frozenset())
+
+            self.Company.write([company], {
+                'project_admins': [('add', [registered_user.id])],
+            })
+            self.assertEqual(
+                company.get_project_admin_ids(),
+                frozenset([registered_user.id])
+            )
+
+            self.Company.write([company], {
+                'project_admins': [('unlink', [registered_user.id])],
+            })
+            self.assertEqual(company.get_project_admin_ids(), frozenset())
+
 
 def suite():
     "Nereid test suite"
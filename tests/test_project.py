@@ -10,6 +10,7 @@
 import unittest
 import json
 import smtplib
+from datetime import datetime
 from StringIO import StringIO
 
 from trytond.config import CONFIG
@@ -849,6 +850,97 @@ class TestNereidProject(NereidTestCase):
                     response = c.get('/en_US/project-%d/-files' % project.id)
                     self.assertEqual(response.data, '1')
 
+    def test_0135_render_files_sorted(self):
+        """
+        The files of a project and its tasks are listed together, sorted
+        and filtered
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.create_defaults()
+            app = self.get_app(DEBUG=True)
+
+            project = self.Project.create({
+                'name': 'ABC',
+                'type': 'project',
+                'company': data['company'].id,
+                'parent': False,
+                'state': 'opened',
+            })
+            task1 = self.Project.create({
+                'name': 'ABC_task',
+                'comment': 'task_desc',
+                'parent': project.id,
+                'company': data['company'].id,
+            })
+            task2 = self.Project.create({
+                'name': 'DEF_task',
+                'comment': 'task_desc',
+                'parent': project.id,
+                'company': data['company'].id,
+            })
+            for name, work in [
+                    ('b.txt', project), ('c.txt', task1), ('a.txt', task2)]:
+                self.Attachment.create({
+                    'name': name,
+                    'type': 'link',
+                    'link': 'http://example.com/' + name,
+                    'resource': 'project.work,%d' % work.id,
+                })
+            self.Attachment.create({
+                'name': 'd.txt',
+                'type': 'data',
+                'data': 'data',
+                'resource': 'project.work,%d' % task1.id,
+            })
+
+            with app.test_client() as c:
+                response = c.post('/en_US/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+                with Transaction().set_context({
+                    'company': data['company'].id
+                }):
+                    response = c.get(
+                        '/en_US/project-%d/-files?order=name' % project.id,
+                        headers=[('X-Requested-With', 'XMLHttpRequest')]
+                    )
+                    result = json.loads(response.data)
+                    self.assertEqual(result['count'], 4)
+                    self.assertEqual(
+                        [(i['name'], i['work']) for i in result['items']], [
+                            ('a.txt', task2.id),
+                            ('b.txt', project.id),
+                            ('c.txt', task1.id),
+                            ('d.txt', task1.id),
+                        ]
+                    )
+
+                    # Links have no size and come after the files
+                    response = c.get(
+                        '/en_US/project-%d/-files?order=size' % project.id,
+                        headers=[('X-Requested-With', 'XMLHttpRequest')]
+                    )
+                    result = json.loads(response.data)
+                    self.assertEqual(
+                        [i['name'] for i in result['items']],
+                        ['d.txt', 'a.txt', 'c.txt', 'b.txt']
+                    )
+
+                    response = c.get(
+                        '/en_US/project-%d/-files?type=data' % project.id,
+                        headers=[('X-Requested-With', 'XMLHttpRequest')]
+                    )
+                    result = json.loads(response.data)
+                    self.assertEqual(
+                        [i['name'] for i in result['items']], ['d.txt']
+                    )
+
+                    response = c.get(
+                        '/en_US/project-%d/-files?order=random' % project.id
+                    )
+                    self.assertEqual(response.status_code, 400)
+
     def test_0140_download_file(self):
         """
         Checks the same file is downloaded
@@ -1142,6 +1234,84 @@ class TestNereidProject(NereidTestCase):
                     self.assertTrue(json.loads(response.data)['success'])
                     self.assertEqual(response.status_code, 200)
 
+    def test_0190_resend_invite_queues_mail(self):
+        """
+        The invitation mail is queued in the outbox, and retried later when
+        it cannot be sent
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.create_defaults()
+            Outbox = POOL.get('project.mail.outbox')
+            app = self.get_app(DEBUG=True)
+
+            project = self.Project.create({
+                'name': 'ABC',
+                'type': 'project',
+                'company': data['company'].id,
+                'parent': False,
+                'state': 'opened',
+            })
+            invitation = self.ProjectInvitation.create({
+                'email': 'example@example.com',
+                'invitation_code': '123',
+                'nereid_user': data['registered_user3'].id,
+                'project': project.id,
+            })
+            with app.test_client() as c:
+                response = c.post('/en_US/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+                with Transaction().set_context({
+                    'company': data['company'].id
+                }):
+                    response = c.post(
+                        'en_US/invitation-%d/-resend' % invitation.id,
+                        headers=self.xhr_header,
+                    )
+                    self.assertEqual(response.status_code, 200)
+
+            mail, = Outbox.search([])
+            self.assertEqual(mail.state, 'pending')
+            self.assertEqual(mail.to_addrs, 'example@example.com')
+            self.assertTrue('[ABC]' in mail.subject)
+
+            # Subjects with non-ASCII project names are queued as well
+            self.Project.write([project], {'name': u'Caf\xe9'})
+            with app.test_client() as c:
+                response = c.post('/en_US/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+                with Transaction().set_context({
+                    'company': data['company'].id
+                }):
+                    response = c.post(
+                        'en_US/invitation-%d/-resend' % invitation.id,
+                        headers=self.xhr_header,
+                    )
+                    self.assertEqual(response.status_code, 200)
+            accented, = Outbox.search([('id', '!=', mail.id)])
+            self.assertTrue(u'[Caf\xe9]' in accented.subject)
+
+            mail.retry(smtplib.SMTPException('Try again'))
+            mail = Outbox(mail.id)
+            self.assertEqual(mail.attempts, 1)
+            self.assertTrue(mail.next_attempt > datetime.now())
+            self.assertEqual(mail.state, 'pending')
+
+            for attempt in range(5):
+                mail.retry(smtplib.SMTPException('Try again'))
+                mail = Outbox(mail.id)
+            self.assertEqual(mail.state, 'failed')
+
+            # Recipients refused by the server are recorded on the mail
+            self.assertEqual(mail.get_refused_error({}), None)
+            error = mail.get_refused_error({
+                'example@example.com': (550, 'No such user'),
+            })
+            self.assertTrue('example@example.com: 550 No such user' in error)
+
 
 def suite():
     "Nereid test suite"
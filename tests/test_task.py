@@ -7,9 +7,16 @@
     :copyright: (c) 2013 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+import os
 import unittest
 import json
 import smtplib
+import hashlib
+from StringIO import StringIO
+from email import message_from_string
+from datetime import datetime
+
+from dateutil.relativedelta import relativedelta
 
 from trytond.config import CONFIG
 CONFIG['smtp_from'] = 'test@openlabs.co.in'
@@ -21,6 +28,8 @@ from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
 from trytond.transaction import Transaction
 #from trytond.error import UserError
 from nereid.testing import NereidTestCase
+from trytond.modules.nereid_project.project import MAIL_HISTORY_LIMIT, \
+    TIMELINE_LIMIT
 
 smtplib.SMTP = Mock('smtplib.SMTP')
 smtplib.SMTP.mock_returns = Mock('smtp_connection')
@@ -244,7 +253,12 @@ class TestTask(NereidTestCase):
             'localhost/project/comment.jinja': '',
             'localhost/project/emails/text_content.jinja': '',
             'localhost/project/emails/html_content.jinja': '',
+            'localhost/project/emails/digest_item_text.jinja':
+                '{{ history.comment }}',
+            'localhost/project/emails/digest_item_html.jinja':
+                '<p>{{ history.comment }}</p>',
             'localhost/project/task.jinja': '{{ task.id }}',
+            'localhost/project/timeline.jinja': '{{ comments|length }}',
             'localhost/project/comment.jinja': '',
             'localhost/project/tasks-by-employee.jinja':
                 '',
@@ -1042,6 +1056,1248 @@ class TestTask(NereidTestCase):
                         2
                     )
 
+    def test_0200_effective_members(self):
+        """
+        The effective members of a task follow the participants of the
+        task and of its project.
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.create_task_dafaults()
+            project = data['project1']
+            task = data['task2']
+            user1 = data['registered_user1']
+            user2 = data['registered_user2']
+
+            # Inherited from the project
+            self.assertEqual(
+                set(task.members), set([user1, user2])
+            )
+            self.assertTrue(user2 in task.all_participants)
+
+            Member = POOL.get('project.work.member')
+            member, = Member.search([
+                ('work', '=', task.id), ('user', '=', user1.id),
+            ])
+            self.Project.write(
+                [project], {'participants': [('unlink', [user2.id])]}
+            )
+            self.assertEqual(set(self.Project(task.id).members), set([user1]))
+            # The members which did not change are left as they were
+            self.assertEqual(Member.search([
+                ('work', '=', task.id), ('user', '=', user1.id),
+            ]), [member])
+
+            # user1 is a project admin, so remains in all participants
+            self.Project.write(
+                [project], {'participants': [('unlink', [user1.id])]}
+            )
+            task = self.Project(task.id)
+            self.assertEqual(len(task.members), 0)
+            self.assertEqual(list(task.all_participants), [user1])
+
+            # Participants of the task itself
+            self.Project.write(
+                [task], {'participants': [('add', [user2.id])]}
+            )
+            self.assertEqual(list(self.Project(task.id).members), [user2])
+
+            # The members of many tasks are inserted in several statements
+            # which stay below the number of parameters of the database
+            for index in range(Transaction().cursor.IN_MAX // 4 + 1):
+                self.Project.create({
+                    'name': 'Bulk task %d' % index,
+                    'parent': project.id,
+                    'company': data['company'].id,
+                })
+            self.Project.write(
+                [project], {'participants': [('add', [user1.id])]}
+            )
+            work_ids = map(int, self.Project.search([
+                'OR',
+                ('id', '=', project.id),
+                ('parent', '=', project.id),
+            ]))
+            self.assertEqual(Member.search([
+                ('user', '=', user1.id), ('work', 'in', work_ids),
+            ], count=True), len(work_ids))
+
+    def test_0210_task_access(self):
+        """
+        Only the members of a project and the project admins can access its
+        tasks.
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.create_task_dafaults()
+            app = self.get_app()
+            task = data['task1']
+
+            login_data = {
+                'email': 'example@example.com',
+                'password': 'password',
+            }
+            with app.test_client() as c:
+                response = c.post('/en_US/login', data=login_data)
+                self.assertEqual(response.status_code, 302)
+
+                with Transaction().set_context(
+                    {'company': data['company'].id}
+                ):
+                    response = c.get(
+                        '/en_US/project-%d/task-%d' % (
+                            data['project1'].id, task.id
+                        )
+                    )
+                    self.assertEqual(response.status_code, 200)
+
+                    # Remove the user from the project and its tasks
+                    self.Project.write(
+                        [data['project1'], task], {
+                            'participants': [
+                                ('unlink', [data['registered_user2'].id])
+                            ]
+                        }
+                    )
+                    response = c.get(
+                        '/en_US/project-%d/task-%d' % (
+                            data['project1'].id, task.id
+                        )
+                    )
+                    self.assertEqual(response.status_code, 404)
+
+                    response = c.get(
+                        '/en_US/project-%d/task-list' % data['project1'].id
+                    )
+                    self.assertEqual(response.status_code, 404)
+
+    def test_0220_remove_participant(self):
+        """
+        Removing a participant from a project also removes the participant
+        from the tasks and unassigns the tasks, with one history line.
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.create_task_dafaults()
+            app = self.get_app()
+            project = data['project1']
+            task = data['task1']
+            user2 = data['registered_user2']
+
+            self.Project.write([task], {
+                'assigned_to': user2.id,
+                'participants': [('add', [user2.id])],
+            })
+
+            login_data = {
+                'email': 'email@example.com',
+                'password': 'password',
+            }
+            with app.test_client() as c:
+                response = c.post('/en_US/login', data=login_data)
+                self.assertEqual(response.status_code, 302)
+
+                with Transaction().set_context(
+                    {'company': data['company'].id}
+                ):
+                    response = c.post(
+                        '/en_US/project-%d/participant-%d/-remove' %
+                        (project.id, user2.id),
+                        headers=self.xhr_header,
+                    )
+                    self.assertEqual(response.status_code, 200)
+                    self.assertTrue(json.loads(response.data)['success'])
+
+                    task = self.Project(task.id)
+                    self.assertFalse(task.assigned_to)
+                    self.assertFalse(user2 in task.participants)
+                    self.assertFalse(user2 in self.Project(project.id).members)
+
+                    history, = self.History.search([
+                        ('project', '=', project.id),
+                    ])
+                    self.assertTrue('1 task' in history.comment)
+
+    def test_0230_render_task_search_comments(self):
+        """
+        The search on task list also matches the comments of the tasks
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.create_task_dafaults()
+            app = self.get_app()
+
+            self.History.create({
+                'project': data['task2'].id,
+                'comment': 'Deployment checklist',
+            })
+
+            login_data = {
+                'email': 'email@example.com',
+                'password': 'password',
+            }
+            with app.test_client() as c:
+                response = c.post('/en_US/login', data=login_data)
+                self.assertEqual(response.status_code, 302)
+
+                with Transaction().set_context(
+                    {'company': data['company'].id}
+                ):
+                    response = c.get(
+                        '/en_US/project-%d/task-list?q=checklist' %
+                        data['project1'].id, headers=self.xhr_header,
+                    )
+                    result = json.loads(response.data)
+                    self.assertEqual(result['count'], 1)
+                    self.assertEqual(
+                        result['items'][0]['id'], data['task2'].id
+                    )
+
+            # The matches are paged by the database in the order of rank
+            domain = [('parent', '=', data['project1'].id)]
+            matches = self.Project.search_fulltext('task_desc', domain)
+            self.assertEqual(len(matches), 3)
+            self.assertEqual(
+                self.Project.search_fulltext(
+                    'task_desc', domain, offset=1, limit=1
+                ), matches[1:2]
+            )
+            counts = self.Project.get_facet_counts(domain, 'checklist')
+            self.assertEqual(counts['all_tasks_count'], 1)
+
+    def test_0240_typeahead(self):
+        """
+        Typeahead on tasks by name and by #id
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.create_task_dafaults()
+            app = self.get_app()
+
+            login_data = {
+                'email': 'email@example.com',
+                'password': 'password',
+            }
+            with app.test_client() as c:
+                response = c.post('/en_US/login', data=login_data)
+                self.assertEqual(response.status_code, 302)
+
+                with Transaction().set_context(
+                    {'company': data['company'].id}
+                ):
+                    response = c.get('/en_US/tasks/-typeahead?q=task2')
+                    items = json.loads(response.data)['items']
+                    self.assertEqual(len(items), 1)
+                    self.assertEqual(items[0]['id'], data['task2'].id)
+
+                    response = c.get(
+                        '/en_US/tasks/-typeahead?q=%%23%d' % data['task3'].id
+                    )
+                    items = json.loads(response.data)['items']
+                    self.assertEqual(len(items), 1)
+                    self.assertEqual(items[0]['name'], 'ABC_task3')
+
+                    # Wildcards are matched literally
+                    response = c.get('/en_US/tasks/-typeahead?q=%25')
+                    self.assertEqual(json.loads(response.data)['items'], [])
+
+                    # The limit is at least one task
+                    response = c.get('/en_US/tasks/-typeahead?q=task&limit=0')
+                    self.assertEqual(
+                        len(json.loads(response.data)['items']), 1
+                    )
+
+    def test_0250_task_list_facet_counts(self):
+        """
+        The task list returns the counts by state and the facet counts
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.create_task_dafaults()
+            app = self.get_app()
+
+            self.Project.write([data['task3']], {'state': 'done'})
+
+            login_data = {
+                'email': 'email@example.com',
+                'password': 'password',
+            }
+            with app.test_client() as c:
+                response = c.post('/en_US/login', data=login_data)
+                self.assertEqual(response.status_code, 302)
+
+                with Transaction().set_context(
+                    {'company': data['company'].id}
+                ):
+                    response = c.get(
+                        '/en_US/project-%d/task-list' % data['project1'].id,
+                        headers=self.xhr_header,
+                    )
+                    counts = json.loads(response.data)['counts']
+                    self.assertEqual(counts['opened_tasks_count'], 2)
+                    self.assertEqual(counts['done_tasks_count'], 1)
+                    self.assertEqual(counts['all_tasks_count'], 3)
+                    self.assertEqual(
+                        counts['tags'], {str(data['tag2'].id): 2}
+                    )
+                    self.assertEqual(counts['progress_state']['Backlog'], 3)
+
+    def test_0260_task_list_keyset_pagination(self):
+        """
+        The task list is paginated with a cursor to the next page
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.create_task_dafaults()
+            app = self.get_app()
+
+            login_data = {
+                'email': 'email@example.com',
+                'password': 'password',
+            }
+            with app.test_client() as c:
+                response = c.post('/en_US/login', data=login_data)
+                self.assertEqual(response.status_code, 302)
+
+                with Transaction().set_context(
+                    {'company': data['company'].id}
+                ):
+                    for order in ('id', 'updated'):
+                        response = c.get(
+                            '/en_US/project-%d/task-list?limit=2&order=%s' %
+                            (data['project1'].id, order),
+                            headers=self.xhr_header,
+                        )
+                        result = json.loads(response.data)
+                        self.assertEqual(len(result['items']), 2)
+                        self.assertTrue(result['next'])
+                        ids = [item['id'] for item in result['items']]
+
+                        response = c.get(
+                            '/en_US/project-%d/task-list?limit=2&order=%s'
+                            '&cursor=%s' % (
+                                data['project1'].id, order, result['next']
+                            ), headers=self.xhr_header,
+                        )
+                        result = json.loads(response.data)
+                        self.assertEqual(len(result['items']), 1)
+                        self.assertEqual(result['next'], None)
+                        ids.append(result['items'][0]['id'])
+
+                        self.assertEqual(len(set(ids)), 3)
+
+                    # The size of a page is validated
+                    for limit in ('0', '-1', 'abc'):
+                        response = c.get(
+                            '/en_US/project-%d/task-list?limit=%s' % (
+                                data['project1'].id, limit
+                            ), headers=self.xhr_header,
+                        )
+                        self.assertEqual(response.status_code, 400)
+                    response = c.get(
+                        '/en_US/project-%d/task-list?limit=1000' %
+                        data['project1'].id, headers=self.xhr_header,
+                    )
+                    self.assertEqual(response.status_code, 200)
+                    self.assertEqual(
+                        len(json.loads(response.data)['items']), 3
+                    )
+
+    def test_0270_serialize_many(self):
+        """
+        Bulk serialization of tasks
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.create_task_dafaults()
+            Attachment = POOL.get('ir.attachment')
+
+            self.Project.write([data['task1']], {
+                'assigned_to': data['registered_user2'].id,
+            })
+            Attachment.create({
+                'name': 'spec.txt',
+                'type': 'link',
+                'link': 'http://example.com/spec.txt',
+                'resource': 'project.work,%d' % data['task1'].id,
+            })
+
+            task1, task2, task3 = self.Project.serialize_many([
+                data['task1'], data['task2'], data['task3']
+            ])
+            self.assertEqual(task1['id'], data['task1'].id)
+            self.assertEqual(task1['tags'], ['tag2'])
+            self.assertEqual(task1['attachments'], 1)
+            self.assertEqual(
+                task1['assigned_to']['id'], data['registered_user2'].id
+            )
+            self.assertEqual(task1['parent'], data['project1'].id)
+            self.assertEqual(task2['tags'], ['tag2'])
+            self.assertEqual(task3['tags'], [])
+            self.assertEqual(task3['attachments'], 0)
+            self.assertEqual(task3['assigned_to'], None)
+
+            self.assertEqual(data['task1'].serialize(), task1)
+
+    def test_0280_task_list_sparse_fields(self):
+        """
+        Only the fields asked for are returned by the task list
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.create_task_dafaults()
+            app = self.get_app()
+
+            login_data = {
+                'email': 'email@example.com',
+                'password': 'password',
+            }
+            with app.test_client() as c:
+                response = c.post('/en_US/login', data=login_data)
+                self.assertEqual(response.status_code, 302)
+
+                with Transaction().set_context(
+                    {'company': data['company'].id}
+                ):
+                    response = c.get(
+                        '/en_US/project-%d/task-list?fields=name,tags' %
+                        data['project1'].id, headers=self.xhr_header,
+                    )
+                    items = json.loads(response.data)['items']
+                    self.assertEqual(len(items), 3)
+                    for item in items:
+                        self.assertEqual(
+                            set(item.keys()), set(['id', 'name', 'tags'])
+                        )
+
+                    response = c.get(
+                        '/en_US/project-%d/task-list?fields=name,password' %
+                        data['project1'].id, headers=self.xhr_header,
+                    )
+                    self.assertEqual(response.status_code, 400)
+
+    def test_0290_task_list_stream(self):
+        """
+        The task list can be streamed with all the tasks
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.create_task_dafaults()
+            app = self.get_app()
+
+            login_data = {
+                'email': 'email@example.com',
+                'password': 'password',
+            }
+            with app.test_client() as c:
+                response = c.post('/en_US/login', data=login_data)
+                self.assertEqual(response.status_code, 302)
+
+                with Transaction().set_context(
+                    {'company': data['company'].id}
+                ):
+                    response = c.get(
+                        '/en_US/project-%d/task-list?stream=1&limit=1' %
+                        data['project1'].id, headers=self.xhr_header,
+                    )
+                    self.assertEqual(response.status_code, 200)
+                    result = json.loads(response.data)
+                    self.assertEqual(len(result['items']), 3)
+                    self.assertEqual(result['counts']['all_tasks_count'], 3)
+
+    def test_0300_render_task_conditional(self):
+        """
+        A task page which has not changed is answered with a 304
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.create_task_dafaults()
+            app = self.get_app()
+            task = data['task1']
+
+            login_data = {
+                'email': 'email@example.com',
+                'password': 'password',
+            }
+            with app.test_client() as c:
+                response = c.post('/en_US/login', data=login_data)
+                self.assertEqual(response.status_code, 302)
+
+                with Transaction().set_context(
+                    {'company': data['company'].id}
+                ):
+                    url = '/en_US/project-%d/task-%d' % (
+                        task.parent.id, task.id
+                    )
+                    response = c.get(url)
+                    self.assertEqual(response.status_code, 200)
+                    etag = response.headers['ETag']
+                    self.assertTrue(etag)
+
+                    response = c.get(url, headers=[('If-None-Match', etag)])
+                    self.assertEqual(response.status_code, 304)
+                    self.assertEqual(response.data, '')
+
+                    # A new comment changes the page
+                    self.History.create({
+                        'project': task.id,
+                        'updated_by': data['registered_user1'].id,
+                        'comment': 'comment1',
+                    })
+                    response = c.get(url, headers=[('If-None-Match', etag)])
+                    self.assertEqual(response.status_code, 200)
+                    self.assertNotEqual(response.headers['ETag'], etag)
+
+                    # So does a participant removed without a write
+                    self.Project.write([task], {
+                        'participants': [
+                            ('add', [data['registered_user2'].id])
+                        ],
+                    })
+                    etag = c.get(url).headers['ETag']
+                    self.Project.remove_participant_from_works(
+                        [task.id], data['registered_user2'].id
+                    )
+                    response = c.get(url, headers=[('If-None-Match', etag)])
+                    self.assertEqual(response.status_code, 200)
+                    self.assertNotEqual(response.headers['ETag'], etag)
+
+                    # And a member shown on the page who is renamed
+                    etag = response.headers['ETag']
+                    self.NereidUser.write([data['registered_user1']], {
+                        'display_name': 'Renamed User',
+                    })
+                    response = c.get(url, headers=[('If-None-Match', etag)])
+                    self.assertEqual(response.status_code, 200)
+                    self.assertNotEqual(response.headers['ETag'], etag)
+
+                    # A page with pending flashed messages is rendered
+                    etag = response.headers['ETag']
+                    with c.session_transaction() as session:
+                        session['_flashes'] = [('message', 'Not allowed')]
+                    response = c.get(url, headers=[('If-None-Match', etag)])
+                    self.assertEqual(response.status_code, 200)
+                    self.assertFalse('ETag' in response.headers)
+
+    def test_0310_task_counters(self):
+        """
+        The counters of a task follow its history and attachments
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.create_task_dafaults()
+            Attachment = POOL.get('ir.attachment')
+            task = data['task1']
+
+            self.assertEqual(task.comment_count, 0)
+            self.assertEqual(task.attachment_count, 0)
+
+            comment = self.History.create({
+                'project': task.id,
+                'updated_by': data['registered_user1'].id,
+                'comment': 'comment1',
+            })
+            attachment = Attachment.create({
+                'name': 'spec.txt',
+                'type': 'link',
+                'link': 'http://example.com/spec.txt',
+                'resource': 'project.work,%d' % task.id,
+            })
+
+            task = self.Project(task.id)
+            self.assertEqual(task.comment_count, 1)
+            self.assertEqual(task.attachment_count, 1)
+            self.assertEqual(
+                self.Project(data['task2'].id).comment_count, 0
+            )
+
+            self.History.delete([comment])
+            Attachment.delete([attachment])
+
+            task = self.Project(task.id)
+            self.assertEqual(task.comment_count, 0)
+            self.assertEqual(task.attachment_count, 0)
+
+            # Resources can also be given as (model, id) pairs
+            attachment = Attachment.create({
+                'name': 'spec.txt',
+                'type': 'link',
+                'link': 'http://example.com/spec.txt',
+                'resource': (self.Project.__name__, task.id),
+            })
+            self.assertEqual(self.Project(task.id).attachment_count, 1)
+            Attachment.write([attachment], {
+                'resource': (self.Project.__name__, data['task2'].id),
+            })
+            self.assertEqual(self.Project(task.id).attachment_count, 0)
+            self.assertEqual(
+                self.Project(data['task2'].id).attachment_count, 1
+            )
+
+    def test_0320_download_file_range(self):
+        """
+        Attachments are downloaded whole, by range and conditionally
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.create_task_dafaults()
+            Attachment = POOL.get('ir.attachment')
+            app = self.get_app()
+            task = data['task1']
+
+            attachment = Attachment.create({
+                'name': 'notes.txt',
+                'type': 'data',
+                'data': 'abcdefghij',
+                'resource': 'project.work,%d' % task.id,
+            })
+
+            login_data = {
+                'email': 'email@example.com',
+                'password': 'password',
+            }
+            with app.test_client() as c:
+                response = c.post('/en_US/login', data=login_data)
+                self.assertEqual(response.status_code, 302)
+
+                with Transaction().set_context(
+                    {'company': data['company'].id}
+                ):
+                    url = '/en_US/attachment-%d/-download?task=%d' % (
+                        attachment.id, task.id
+                    )
+                    response = c.get(url)
+                    self.assertEqual(response.status_code, 200)
+                    self.assertEqual(response.data, 'abcdefghij')
+                    self.assertEqual(
+                        response.headers['Content-Length'], '10'
+                    )
+                    etag = response.headers['ETag']
+
+                    response = c.get(url, headers=[('Range', 'bytes=2-4')])
+                    self.assertEqual(response.status_code, 206)
+                    self.assertEqual(response.data, 'cde')
+                    self.assertEqual(
+                        response.headers['Content-Range'], 'bytes 2-4/10'
+                    )
+
+                    response = c.get(url, headers=[('Range', 'bytes=20-')])
+                    self.assertEqual(response.status_code, 416)
+
+                    response = c.get(url, headers=[('If-None-Match', etag)])
+                    self.assertEqual(response.status_code, 304)
+
+                    # Only attachments of the given task can be downloaded
+                    response = c.get(
+                        '/en_US/attachment-%d/-download?task=%d' % (
+                            attachment.id, data['task2'].id
+                        )
+                    )
+                    self.assertEqual(response.status_code, 404)
+
+    def test_0330_resumable_upload(self):
+        """
+        A file uploaded in chunks becomes an attachment of the task
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.create_task_dafaults()
+            app = self.get_app()
+            task = data['task1']
+
+            login_data = {
+                'email': 'email@example.com',
+                'password': 'password',
+            }
+            with app.test_client() as c:
+                response = c.post('/en_US/login', data=login_data)
+                self.assertEqual(response.status_code, 302)
+
+                response = c.post('/en_US/attachment/-upload-start', data={
+                    'task': task.id,
+                    'name': 'notes.txt',
+                    'size': 10,
+                })
+                self.assertEqual(response.status_code, 200)
+                url = json.loads(response.data)['url']
+
+                response = c.post(url, data={
+                    'offset': 0,
+                    'file': (StringIO('abcdef'), 'notes.txt'),
+                })
+                self.assertEqual(json.loads(response.data)['offset'], 6)
+
+                # A chunk at the wrong offset is refused
+                response = c.post(url, data={
+                    'offset': 2,
+                    'file': (StringIO('cdefghij'), 'notes.txt'),
+                })
+                self.assertEqual(response.status_code, 409)
+
+                # Resume from where the upload stopped
+                response = c.get(url)
+                self.assertEqual(json.loads(response.data)['offset'], 6)
+                response = c.post(url, data={
+                    'offset': 6,
+                    'file': (StringIO('ghij'), 'notes.txt'),
+                })
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(json.loads(response.data)['attachment'])
+
+                task = self.Project(task.id)
+                attachment, = task.attachments
+                self.assertEqual(attachment.name, 'notes.txt')
+                self.assertEqual(str(attachment.data), 'abcdefghij')
+                self.assertEqual(attachment.file_size, 10)
+
+    def test_0340_upload_size_limit(self):
+        """
+        Files larger than the configured maximum are refused
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.create_task_dafaults()
+            app = self.get_app()
+            task = data['task1']
+
+            login_data = {
+                'email': 'email@example.com',
+                'password': 'password',
+            }
+            CONFIG['project_max_file_size'] = 5
+            try:
+                with app.test_client() as c:
+                    response = c.post('/en_US/login', data=login_data)
+                    self.assertEqual(response.status_code, 302)
+
+                    response = c.post('/en_US/attachment/-upload', data={
+                        'task': task.id,
+                        'file': (StringIO('abcdefghij'), 'notes.txt'),
+                    })
+                    self.assertEqual(response.status_code, 413)
+
+                    response = c.post(
+                        '/en_US/attachment/-upload-start', data={
+                            'task': task.id,
+                            'name': 'notes.txt',
+                            'size': 10,
+                        }
+                    )
+                    self.assertEqual(response.status_code, 413)
+
+                    response = c.post('/en_US/attachment/-upload', data={
+                        'task': task.id,
+                        'file': (StringIO('abc'), 'notes.txt'),
+                    }, headers=self.xhr_header)
+                    self.assertEqual(response.status_code, 200)
+            finally:
+                CONFIG.options.pop('project_max_file_size', None)
+
+            task = self.Project(task.id)
+            attachment, = task.attachments
+            self.assertEqual(str(attachment.data), 'abc')
+
+    def test_0350_deduplicated_uploads(self):
+        """
+        Uploads of the same content share one blob of the store
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.create_task_dafaults()
+            Attachment = POOL.get('ir.attachment')
+            Blob = POOL.get('project.work.blob')
+            app = self.get_app()
+
+            login_data = {
+                'email': 'email@example.com',
+                'password': 'password',
+            }
+            with app.test_client() as c:
+                response = c.post('/en_US/login', data=login_data)
+                self.assertEqual(response.status_code, 302)
+
+                for task in (data['task1'], data['task2']):
+                    response = c.post('/en_US/attachment/-upload', data={
+                        'task': task.id,
+                        'file': (StringIO('same content'), 'spec.txt'),
+                    }, headers=self.xhr_header)
+                    self.assertEqual(response.status_code, 200)
+
+                attachment1, = self.Project(data['task1'].id).attachments
+                attachment2, = self.Project(data['task2'].id).attachments
+                self.assertEqual(attachment1.blob, attachment2.blob)
+                blob, = Blob.search([])
+                self.assertEqual(blob.ref_count, 2)
+                self.assertEqual(blob.size, len('same content'))
+
+                response = c.get(
+                    '/en_US/attachment-%d/-download?task=%d' % (
+                        attachment2.id, data['task2'].id
+                    )
+                )
+                self.assertEqual(response.data, 'same content')
+                self.assertEqual(
+                    response.headers['ETag'], '"%s"' % blob.sha256
+                )
+
+            # Rewriting the content moves the attachment to another blob
+            Attachment.write([attachment1], {'data': 'new content'})
+            attachment1 = Attachment(attachment1.id)
+            self.assertNotEqual(attachment1.blob, blob)
+            self.assertEqual(
+                attachment1.get_etag(),
+                hashlib.sha256('new content').hexdigest()
+            )
+            self.assertEqual(attachment1.file_size, len('new content'))
+            self.assertEqual(Blob(blob.id).ref_count, 1)
+            self.assertEqual(attachment1.blob.ref_count, 1)
+
+            Attachment.delete([attachment1])
+            self.assertEqual(Blob(blob.id).ref_count, 1)
+
+            # Blobs in use or in their grace period are kept
+            path = Attachment.get_store_path(blob.digest, blob.collision)
+            Attachment.delete([attachment2])
+            self.assertEqual(Blob.delete_unused(), [])
+            self.assertEqual(Blob(blob.id).ref_count, 0)
+            self.assertTrue(Blob.search([('id', '=', blob.id)]))
+
+            # Unused blobs are deleted and their files removed afterwards
+            Transaction().cursor.execute(
+                'UPDATE "' + Blob._table + '" SET "write_date" = %s '
+                'WHERE "id" = %s',
+                (datetime.now() - relativedelta(days=1), blob.id)
+            )
+            paths = Blob.delete_unused()
+            self.assertEqual(paths, [path])
+            self.assertFalse(Blob.search([('id', '=', blob.id)]))
+            self.assertTrue(os.path.exists(path))
+            Blob.remove_files(paths)
+            self.assertFalse(os.path.exists(path))
+
+    def test_0360_image_thumbnails(self):
+        """
+        Thumbnails of uploaded images are generated and served
+        """
+        try:
+            from PIL import Image
+        except ImportError:
+            self.skipTest('PIL is not installed')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.create_task_dafaults()
+            Thumbnail = POOL.get('project.work.thumbnail')
+            app = self.get_app()
+            task = data['task1']
+
+            image_file = StringIO()
+            Image.new('RGB', (800, 600), 'red').save(image_file, 'PNG')
+
+            login_data = {
+                'email': 'email@example.com',
+                'password': 'password',
+            }
+            with app.test_client() as c:
+                response = c.post('/en_US/login', data=login_data)
+                self.assertEqual(response.status_code, 302)
+
+                response = c.post('/en_US/attachment/-upload', data={
+                    'task': task.id,
+                    'file': (StringIO(image_file.getvalue()), 'red.png'),
+                }, headers=self.xhr_header)
+                self.assertEqual(response.status_code, 200)
+                attachment, = self.Project(task.id).attachments
+                url = '/en_US/attachment-%d/-thumbnail?task=%d' % (
+                    attachment.id, task.id
+                )
+
+                # Not generated yet
+                response = c.get(url)
+                self.assertEqual(response.status_code, 404)
+
+                thumbnail, = Thumbnail.search([
+                    ('attachment', '=', attachment.id),
+                    ('state', '=', 'pending'),
+                ])
+                thumbnail.generate()
+
+                response = c.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.mimetype, 'image/jpeg')
+                self.assertEqual(
+                    Image.open(StringIO(response.data)).size, (160, 120)
+                )
+
+                response = c.get(url + '&size=preview')
+                self.assertEqual(
+                    Image.open(StringIO(response.data)).size, (800, 600)
+                )
+
+    def test_0370_digest_notifications(self):
+        """
+        Users in digest mode get the updates in a digest instead of a mail
+        per update
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.create_task_dafaults()
+            Outbox = POOL.get('project.mail.outbox')
+            Notification = POOL.get('project.work.notification')
+            app = self.get_app()
+            task = data['task1']
+            digest_user = data['registered_user2']
+
+            self.NereidUser.write([digest_user], {
+                'notification_mode': 'digest',
+                'digest_interval': 30,
+            })
+            self.Project.write([task], {
+                'participants': [
+                    ('add', [data['registered_user1'].id, digest_user.id])
+                ],
+            })
+
+            login_data = {
+                'email': 'email@example.com',
+                'password': 'password',
+            }
+            with app.test_client() as c:
+                response = c.post('/en_US/login', data=login_data)
+                self.assertEqual(response.status_code, 302)
+
+                with Transaction().set_context(
+                    {'company': data['company'].id}
+                ):
+                    for comment in ('comment1', 'comment2'):
+                        response = c.post(
+                            '/en_US/task-%d/-update' % task.id,
+                            data={'comment': comment},
+                            headers=self.xhr_header,
+                        )
+                        self.assertEqual(response.status_code, 200)
+
+            # No mail is sent to the digest user for every update
+            self.assertFalse(Outbox.search([
+                ('to_addrs', '=', digest_user.email),
+            ]))
+            notifications = Notification.search([
+                ('user', '=', digest_user.id),
+            ], order=[('id', 'ASC')])
+            self.assertEqual(len(notifications), 2)
+
+            message = Notification.build_digest(digest_user, notifications)
+            self.assertEqual(message['To'], digest_user.email)
+            self.assertTrue('2 update(s) on 1 task(s)' in message['Subject'])
+            text, html = message.get_payload()
+            text = text.get_payload(decode=True)
+            self.assertTrue(text.index('comment1') < text.index('comment2'))
+            self.assertTrue(
+                '<p>comment2</p>' in html.get_payload(decode=True)
+            )
+
+            # Queued updates edited later are not sent empty
+            self.History.write(
+                [notifications[0].history], {'comment': 'edited'}
+            )
+            message = Notification.build_digest(
+                digest_user, Notification.browse(map(int, notifications))
+            )
+            text = message.get_payload()[0].get_payload(decode=True)
+            self.assertTrue('edited' in text)
+            self.assertFalse('comment1' in text)
+
+    def test_0380_mail_previous_updates(self):
+        """
+        The mail of an update quotes only the latest previous updates, from
+        their rendering which is kept on the history lines
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.create_task_dafaults()
+            app = self.get_app()
+            task = data['task1']
+            user = data['registered_user2']
+
+            self.Project.write([task], {
+                'participants': [('add', [user.id])],
+            })
+
+            login_data = {
+                'email': 'email@example.com',
+                'password': 'password',
+            }
+            with app.test_client() as c:
+                response = c.post('/en_US/login', data=login_data)
+                self.assertEqual(response.status_code, 302)
+
+                with Transaction().set_context(
+                    {'company': data['company'].id}
+                ):
+                    for index in range(MAIL_HISTORY_LIMIT + 2):
+                        response = c.post(
+                            '/en_US/task-%d/-update' % task.id,
+                            data={'comment': 'comment%d' % index},
+                            headers=self.xhr_header,
+                        )
+                        self.assertEqual(response.status_code, 200)
+
+            latest, = self.History.search([
+                ('project', '=', task.id),
+                ('comment', '=', 'comment%d' % (MAIL_HISTORY_LIMIT + 1)),
+            ])
+            previous = latest.get_previous_updates()
+            self.assertEqual(len(previous), MAIL_HISTORY_LIMIT)
+            self.assertEqual(
+                previous[0].comment, 'comment%d' % MAIL_HISTORY_LIMIT
+            )
+            self.assertEqual(previous[-1].comment, 'comment1')
+            self.assertTrue(
+                all(h.digest_text == h.comment for h in previous)
+            )
+
+            # The rendering is done again when the comment is edited
+            history = previous[-1]
+            with app.test_client() as c:
+                response = c.post('/en_US/login', data=login_data)
+                self.assertEqual(response.status_code, 302)
+
+                with Transaction().set_context(
+                    {'company': data['company'].id}
+                ):
+                    response = c.post(
+                        '/en_US/task-%d/comment-%d/-update' % (
+                            task.id, history.id
+                        ),
+                        data={'comment': 'edited'},
+                        headers=self.xhr_header,
+                    )
+                    self.assertEqual(response.status_code, 200)
+            self.assertEqual(self.History(history.id).digest_text, 'edited')
+
+    def test_0390_mail_rendered_once(self):
+        """
+        The mail of an update is rendered once and queued once for all the
+        receivers
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.create_task_dafaults()
+            Outbox = POOL.get('project.mail.outbox')
+            app = self.get_app()
+            task = data['task1']
+            receivers = [data['registered_user2'], data['guest_user']]
+
+            self.Project.write([task], {
+                'name': u'T\xe2che',
+                'participants': [('add', map(int, receivers))],
+            })
+            template = 'project/emails/text_content.jinja'
+            timings = Outbox.get_render_timings()
+            count = template in timings and timings[template]['count'] or 0
+
+            login_data = {
+                'email': 'email@example.com',
+                'password': 'password',
+            }
+            with app.test_client() as c:
+                response = c.post('/en_US/login', data=login_data)
+                self.assertEqual(response.status_code, 302)
+
+                with Transaction().set_context(
+                    {'company': data['company'].id}
+                ):
+                    response = c.post(
+                        '/en_US/task-%d/-update' % task.id,
+                        data={'comment': 'comment'},
+                        headers=self.xhr_header,
+                    )
+                    self.assertEqual(response.status_code, 200)
+
+            self.assertEqual(
+                Outbox.get_render_timings()[template]['count'], count + 1
+            )
+            mail, = Outbox.search([
+                ('to_addrs', 'like', '%' + receivers[0].email + '%'),
+            ])
+            self.assertEqual(
+                set(mail.to_addrs.split('\n')),
+                set(receiver.email for receiver in receivers)
+            )
+            self.assertTrue(u'T\xe2che' in mail.subject)
+            message = message_from_string(mail.message)
+            for receiver in receivers:
+                self.assertTrue(receiver.email in message['To'])
+
+    def test_0400_history_of_bulk_write(self):
+        """
+        Writing to many tasks at once creates a history line for each task
+        with its own previous values
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.create_task_dafaults()
+            tasks = [data['task1'], data['task2']]
+            self.Project.write([data['task2']], {'state': 'done'})
+            counts = dict(
+                (t.id, t.comment_count)
+                for t in self.Project.browse(map(int, tasks))
+            )
+
+            self.Project.write(tasks, {'state': 'opened'})
+
+            previous_states = {}
+            for task in tasks:
+                line, = self.History.search([
+                    ('project', '=', task.id),
+                    ('new_state', '=', 'opened'),
+                ])
+                self.assertEqual(line.create_uid.id, USER)
+                previous_states[task.id] = line.previous_state
+            self.assertEqual(previous_states, {
+                data['task1'].id: 'opened',
+                data['task2'].id: 'done',
+            })
+
+            for task in self.Project.browse(map(int, tasks)):
+                self.assertEqual(task.comment_count, counts[task.id] + 1)
+
+            # Values which are not historized do not create any line
+            self.Project.write(tasks, {'name': 'Renamed'})
+            self.assertEqual(self.History.search([
+                ('project', 'in', map(int, tasks)),
+            ], count=True), sum(counts.values()) + 2)
+
+            # The lines of many tasks are inserted in several statements
+            # which stay below the number of parameters of the database
+            many_tasks = [
+                self.Project.create({
+                    'name': 'Bulk task %d' % index,
+                    'parent': data['project1'].id,
+                    'company': data['company'].id,
+                })
+                for index in range(Transaction().cursor.IN_MAX // 5 + 1)
+            ]
+            self.Project.write(many_tasks, {'state': 'done'})
+            self.assertEqual(self.History.search([
+                ('project', 'in', map(int, many_tasks)),
+                ('new_state', '=', 'done'),
+            ], count=True), len(many_tasks))
+
+    def test_0410_archive_history(self):
+        """
+        Old history lines of tasks done are moved to the archive, where
+        they remain counted, searchable and readable on demand
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.create_task_dafaults()
+            Archive = POOL.get('project.work.history.archive')
+            cursor = Transaction().cursor
+            app = self.get_app()
+            task = data['task1']
+
+            old_line = self.History.create({
+                'project': task.id,
+                'comment': 'old comment',
+            })
+            self.History.create({
+                'project': task.id,
+                'comment': 'recent comment',
+            })
+            self.Project.write([task], {'state': 'done'})
+            self.assertEqual(Archive.get_archivable_lines(10), [])
+
+            long_ago = datetime.utcnow() - relativedelta(years=1)
+            cursor.execute(
+                'UPDATE "' + self.History._table + '" '
+                'SET "create_date" = %s WHERE "id" = %s',
+                (long_ago, old_line.id)
+            )
+            cursor.execute(
+                'UPDATE "' + self.Project._table + '" '
+                'SET "write_date" = %s WHERE "id" = %s', (long_ago, task.id)
+            )
+            self.assertEqual(Archive.get_archivable_lines(10), [old_line.id])
+
+            comment_count = self.Project(task.id).comment_count
+            Archive.archive_lines([old_line.id])
+            self.assertFalse(self.History.search([('id', '=', old_line.id)]))
+            archived, = Archive.search([('project', '=', task.id)])
+            self.assertEqual(archived.id, old_line.id)
+            self.assertEqual(archived.comment, 'old comment')
+            self.assertEqual(
+                self.Project(task.id).comment_count, comment_count
+            )
+
+            self.Project.update_search_text([task])
+            self.assertTrue(
+                'old comment' in self.Project(task.id).search_text
+            )
+
+            login_data = {
+                'email': 'email@example.com',
+                'password': 'password',
+            }
+            with app.test_client() as c:
+                response = c.post('/en_US/login', data=login_data)
+                self.assertEqual(response.status_code, 302)
+
+                with Transaction().set_context(
+                    {'company': data['company'].id}
+                ):
+                    response = c.get(
+                        '/en_US/task-%d/-archived-history' % task.id,
+                        headers=self.xhr_header,
+                    )
+                    self.assertEqual(response.status_code, 200)
+                    self.assertEqual(json.loads(response.data)['count'], 1)
+
+    def test_0420_task_timeline(self):
+        """
+        The timeline of a task returns its latest entries, and the older
+        ones a page at a time with the cursor
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.create_task_dafaults()
+            Attachment = POOL.get('ir.attachment')
+            app = self.get_app()
+            task = data['task1']
+
+            for index in range(TIMELINE_LIMIT + 3):
+                self.History.create({
+                    'project': task.id,
+                    'comment': 'comment%d' % index,
+                })
+            Attachment.create({
+                'name': 'link',
+                'type': 'link',
+                'link': 'http://openlabs.co.in',
+                'resource': '%s,%d' % (self.Project.__name__, task.id),
+            })
+            task = self.Project(task.id)
+            total = len(
+                task.history + task.timesheet_lines + task.attachments +
+                task.repo_commits
+            )
+            latest, cursor = task.get_timeline()
+            self.assertEqual(len(latest), TIMELINE_LIMIT)
+            self.assertTrue(cursor)
+            older, older_cursor = task.get_timeline(cursor)
+            self.assertEqual(len(older), total - TIMELINE_LIMIT)
+            self.assertEqual(older_cursor, None)
+
+            keys = [
+                (e.create_date, e.__name__, e.id) for e in older + latest
+            ]
+            self.assertEqual(keys, sorted(keys))
+            self.assertEqual(len(set(keys)), total)
+
+            login_data = {
+                'email': 'email@example.com',
+                'password': 'password',
+            }
+            with app.test_client() as c:
+                response = c.post('/en_US/login', data=login_data)
+                self.assertEqual(response.status_code, 302)
+
+                with Transaction().set_context(
+                    {'company': data['company'].id}
+                ):
+                    response = c.get(
+                        '/en_US/task-%d/-timeline?cursor=%s' % (
+                            task.id, cursor
+                        ), headers=self.xhr_header,
+                    )
+                    self.assertEqual(response.status_code, 200)
+                    result = json.loads(response.data)
+                    self.assertEqual(result['count'], len(older))
+                    self.assertEqual(result['next'], None)
+
+                    response = c.get(
+                        '/en_US/task-%d/-timeline?cursor=bad' % task.id,
+                        headers=self.xhr_header,
+                    )
+                    self.assertEqual(response.status_code, 400)
+
 
 def suite():
     "Nereid test suite"